@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# named spans around the commands and file operations of the helper scripts
+#
+# the spans can be written as Chrome trace events (load the file in chrome://tracing
+# or https://ui.perfetto.dev) and summed up as a tree of where the time went:
+#
+#   from phasetrace import tracer
+#
+#   tracer.enable()
+#   with tracer.span("configure", "phase", project = "foo"):
+#       ...
+#   tracer.write("trace.json")
+#   tracer.summary()
+#
+# as long as the tracer is not enabled spans cost next to nothing.
+
+import os
+import json
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+
+def command_name(args):
+    '''
+        short name for a command (list of arguments or shell command line) to use as span
+        name: the program without its path plus its first argument if that is not an
+        option, so "git reset --hard" gives "git reset" and "./configure --prefix=x" gives
+        "configure". leading environment assignments and fakeroot/env are skipped.
+    '''
+    if isinstance(args, basestring):
+        args = args.split()
+    args = list(args)
+    while args and ('=' in args[0] and not args[0].startswith('-') or args[0] in ("fakeroot", "env", "nice")):
+        args.pop(0)
+    if not args:
+        return "command"
+    name = os.path.basename(args[0])
+    if len(args) > 1 and not args[1].startswith('-') and '/' not in args[1] and '=' not in args[1]:
+        name += " " + args[1]
+    return name
+
+
+class Tracer:
+    '''
+        records spans (name, category, start, duration, thread and the names of the spans
+        they are nested in) of all threads. processes forked off (e.g. by multiprocessing)
+        record into their own copy, events_since() and add() carry them back.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.threadnames = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.starttime = time.time()
+
+    def enable(self):
+        '''
+            start recording (again), throwing away what was recorded before
+        '''
+        with self.lock:
+            self.enabled = True
+            self.events = []
+            self.threadnames = {}
+            self.starttime = time.time()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, category = "", **args):
+        if not self.enabled:
+            yield
+            return
+        stack = self.stack()
+        stack.append(name)
+        path = ';'.join(stack)
+        thread = threading.current_thread()
+        starttime = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - starttime
+            stack.pop()
+            with self.lock:
+                self.threadnames[(os.getpid(), thread.ident)] = thread.name
+                self.events.append({ "name" : name, "cat" : category, "path" : path,
+                                     "start" : starttime, "dur" : duration,
+                                     "pid" : os.getpid(), "tid" : thread.ident, "args" : args })
+
+    def traced(self, name, category = ""):
+        '''
+            decorator running the whole function in a span
+        '''
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, category):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def events_since(self, mark):
+        '''
+            the events recorded after len(tracer.events) was mark (with the thread
+            names they need), for handing them on to the parent process
+        '''
+        with self.lock:
+            return self.events[mark:], dict(self.threadnames)
+
+    def add(self, recorded):
+        events, threadnames = recorded
+        with self.lock:
+            self.events.extend(events)
+            self.threadnames.update(threadnames)
+
+    def write(self, fname):
+        '''
+            write the spans as Chrome trace events (complete events in microseconds)
+        '''
+        with self.lock:
+            trace = [ { "name" : "thread_name", "ph" : "M", "pid" : pid, "tid" : tid, "args" : { "name" : name } }
+                      for (pid, tid), name in self.threadnames.items() ]
+            for e in self.events:
+                trace.append({ "name" : e["name"], "cat" : e["cat"], "ph" : "X",
+                               "ts" : int((e["start"] - self.starttime) * 1000000), "dur" : int(e["dur"] * 1000000),
+                               "pid" : e["pid"], "tid" : e["tid"], "args" : e["args"] })
+        tmpname = fname + ".tmp"
+        with open(tmpname, "w") as fh:
+            json.dump({ "traceEvents" : trace, "displayTimeUnit" : "ms" }, fh)
+        os.rename(tmpname, fname)
+
+    def summary(self, mintime = 0.05):
+        '''
+            print the spans as a tree (like a flame graph) with the total time, the time not
+            spent in nested spans and the number of calls of each, summed up over all threads.
+            the total of spans running at the same time is more than the wall time.
+        '''
+        nodes = {} # path -> [ total, nested, calls ]
+        with self.lock:
+            for e in self.events:
+                node = nodes.setdefault(e["path"], [ 0.0, 0.0, 0 ])
+                node[0] += e["dur"]
+                node[2] += 1
+                if ';' in e["path"]:
+                    nodes.setdefault(e["path"].rsplit(';', 1)[0], [ 0.0, 0.0, 0 ])[1] += e["dur"]
+            # spans of forked processes can be nested in spans this process did not record
+            for path in list(nodes):
+                while ';' in path:
+                    path = path.rsplit(';', 1)[0]
+                    nodes.setdefault(path, [ 0.0, 0.0, 0 ])
+
+        children = {}
+        for path in nodes:
+            children.setdefault(path.rsplit(';', 1)[0] if ';' in path else None, []).append(path)
+
+        print("")
+        print("%9s %9s %6s  span" % ("total", "self", "calls"))
+        def show(parent, depth):
+            for path in sorted(children.get(parent, []), key = lambda p: -nodes[p][0]):
+                total, nested, calls = nodes[path]
+                if calls and total < mintime:
+                    continue
+                print("%8.2fs %8.2fs %6d  %s%s" % (total, max(0.0, total - nested), calls, "  " * depth, path.rsplit(';', 1)[-1]))
+                show(path, depth + 1)
+        show(None, 0)
+
+
+tracer = Tracer()
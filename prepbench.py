@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+from getopt import gnu_getopt, GetoptError
+
+import prepscript
+
+
+def usage():
+    print("Usage: %s [<options>] [-- <prepscript options>]" % (os.path.basename(sys.argv[0])))
+    print("       benchmark prepscript on generated autotools projects")
+    print("")
+    print("       a workspace with synthetic projects (git_<proj> dirs, <proj>.conf files and pkg-config")
+    print("       dependencies between the projects) is generated in a temporary directory and prepscript")
+    print("       is run on it in these scenarios:")
+    print("         cold  - fresh workspace, everything needs to be bootstrapped and configured")
+    print("         warm  - second run on the same workspace without any changes")
+    print("         touch - a check added to configure.ac of the first project, so it needs to be bootstrapped")
+    print("                 and configured again (and everything depending on it rebuilt with -b)")
+    print("       the wall and cpu time of each phase (summed up over all projects) and of the whole run is")
+    print("       reported, the projects are generated from a fixed seed so results of different runs can")
+    print("       be compared")
+    print("")
+    print("       Options:")
+    print("         -n,--projects <n>")
+    print("           number of projects to generate (default 10)")
+    print("")
+    print("         -s,--size <n>")
+    print("           size of each project: number of source files and of configure checks (default 10)")
+    print("")
+    print("         -d,--deps <n>")
+    print("           maximum number of other projects each project depends on (default 2)")
+    print("")
+    print("         -r,--runs <n>")
+    print("           repeat each scenario <n> times and report the fastest one (default 3)")
+    print("")
+    print("         --seed <n>")
+    print("           seed for generating the dependencies (default 0)")
+    print("")
+    print("         -o,--output <file>")
+    print("           write the results as JSON to <file>")
+    print("")
+    print("         -c,--compare <file>")
+    print("           compare against the results of an earlier run written with --output")
+    print("")
+    print("         -t,--threshold <percent>")
+    print("           slowdown reported as regression when comparing (default 10)")
+    print("")
+    print("         -k,--keep")
+    print("           keep the generated workspaces")
+    print("")
+    print("       Example:")
+    print("         %s -n 20 -o before.json -- -j 4" % (os.path.basename(sys.argv[0])))
+    print("         (change prepscript)")
+    print("         %s -n 20 -c before.json -- -j 4" % (os.path.basename(sys.argv[0])))
+
+
+# things every system has, so the configure checks are real but never fail
+HEADERS = [ "stdio.h", "stdlib.h", "string.h", "stdint.h", "unistd.h", "fcntl.h", "errno.h",
+            "limits.h", "signal.h", "time.h", "sys/stat.h", "sys/types.h", "sys/time.h" ]
+FUNCS   = [ "malloc", "memcpy", "strdup", "strndup", "gettimeofday", "clock_gettime", "open",
+            "close", "read", "write", "mmap", "munmap", "getpid", "sigaction" ]
+
+
+def generate_project(wsdir, name, size, deps):
+    srcdir = os.path.join(wsdir, "git_%s" % name)
+    os.mkdir(srcdir)
+
+    with open(os.path.join(srcdir, "configure.ac"), "w") as fh:
+        fh.write("AC_INIT([%s],[1.0])\n" % name)
+        fh.write("AM_INIT_AUTOMAKE([foreign])\n")
+        fh.write("AC_PROG_CC\n")
+        fh.write("AC_CHECK_HEADERS([%s])\n" % ' '.join(HEADERS[i % len(HEADERS)] for i in range(size)))
+        fh.write("AC_CHECK_FUNCS([%s])\n" % ' '.join(FUNCS[i % len(FUNCS)] for i in range(size)))
+        for dep in deps:
+            # not finding the module is fine, the projects are not necessarily installed
+            fh.write("PKG_CHECK_MODULES([%s], [lib%s >= 1.0], [], [true])\n" % (dep.upper(), dep))
+        fh.write("AC_CONFIG_FILES([Makefile lib%s.pc])\n" % name)
+        fh.write("AC_OUTPUT\n")
+
+    sources = [ "%s_%d.c" % (name, i) for i in range(size) ]
+    with open(os.path.join(srcdir, "Makefile.am"), "w") as fh:
+        fh.write("bin_PROGRAMS = %s\n" % name)
+        fh.write("%s_SOURCES = %s\n" % (name, ' '.join(sources)))
+        fh.write("pkgconfigdir = $(libdir)/pkgconfig\n")
+        fh.write("pkgconfig_DATA = lib%s.pc\n" % name)
+
+    for i, source in enumerate(sources):
+        with open(os.path.join(srcdir, source), "w") as fh:
+            if i == 0:
+                fh.write("int main(void) { return 0; }\n")
+            else:
+                fh.write("int %s_func%d(int x) { return x * %d; }\n" % (name, i, i))
+
+    with open(os.path.join(srcdir, "lib%s.pc.in" % name), "w") as fh:
+        fh.write("prefix=@prefix@\nName: lib%s\nDescription: %s\nVersion: 1.0\n" % (name, name))
+
+    with open(os.path.join(wsdir, "%s.conf" % name), "w") as fh:
+        fh.write("# generated by prepbench\n")
+        fh.write("--disable-dependency-tracking\n")
+
+
+def touch_project(wsdir, name):
+    '''
+        add a check to configure.ac so the generated configure script really changes
+    '''
+    fname = os.path.join(wsdir, "git_%s" % name, "configure.ac")
+    with open(fname, "r") as fh:
+        text = fh.read()
+    with open(fname, "w") as fh:
+        fh.write(text.replace("AC_OUTPUT", "AC_CHECK_HEADERS([sys/wait.h])\nAC_OUTPUT"))
+
+
+def generate_workspace(wsdir, count, size, maxdeps, seed):
+    '''
+        returns the project names in the order they can be set up
+    '''
+    rnd = random.Random(seed)
+    names = [ "proj%02d" % i for i in range(count) ]
+    for i, name in enumerate(names):
+        deps = rnd.sample(names[:i], min(i, rnd.randint(0, maxdeps)))
+        generate_project(wsdir, name, size, sorted(deps))
+    return names
+
+
+def run_prepscript(wsdir, args):
+    '''
+        run prepscript in the workspace with its output thrown away,
+        returns its timing summary
+    '''
+    olddir = os.getcwd()
+    oldstdout = sys.stdout
+    os.chdir(wsdir)
+    try:
+        with open(os.devnull, "w") as sys.stdout:
+            res = prepscript.main(args)
+    finally:
+        sys.stdout = oldstdout
+        os.chdir(olddir)
+    summary = prepscript.read_stamp(os.path.join(wsdir, prepscript.STATEDIR, "summary.json"))
+    if res != 0 or summary is None:
+        print("Error: prepscript failed in '%s', see the logs in %s" % (wsdir, prepscript.STATEDIR))
+        return None
+    return summary
+
+
+def phase_times(summary):
+    '''
+        { phase : { "wall", "cpu" } } summed up over all projects plus the total as "run"
+    '''
+    result = { "run" : { "wall" : summary["wall"], "cpu" : summary["cpu"] } }
+    for proj in summary["projects"]:
+        for phase in proj["phases"]:
+            entry = result.setdefault(phase["name"], { "wall" : 0.0, "cpu" : 0.0 })
+            entry["wall"] += phase["wall"]
+            entry["cpu"] += phase["cpu"]
+    return result
+
+
+def run_scenarios(params, args, runs, keep):
+    '''
+        returns { scenario : phase_times() } of the fastest run of each scenario
+    '''
+    results = {}
+    for run in range(runs):
+        wsdir = tempfile.mkdtemp(prefix = "prepbench-")
+        try:
+            names = generate_workspace(wsdir, params["projects"], params["size"], params["deps"], params["seed"])
+            runargs = args + names
+            for scenario in ( "cold", "warm", "touch" ):
+                if scenario == "touch":
+                    touch_project(wsdir, names[0])
+                summary = run_prepscript(wsdir, runargs)
+                if summary is None:
+                    keep = True
+                    return None
+                times = phase_times(summary)
+                print("Info: run %d, %-5s %.2fs" % (run + 1, scenario, times["run"]["wall"]))
+                if scenario not in results or times["run"]["wall"] < results[scenario]["run"]["wall"]:
+                    results[scenario] = times
+        finally:
+            if keep:
+                print("Info: workspace kept in '%s'" % wsdir)
+            else:
+                shutil.rmtree(wsdir)
+    return results
+
+
+def report(results, baseline, threshold):
+    '''
+        print the results (compared to the baseline if given),
+        returns the number of regressions
+    '''
+    regressions = 0
+    print("")
+    print("%-6s %-10s %10s %10s%s" % ("", "phase", "wall", "cpu", "    baseline" if baseline else ""))
+    for scenario in ( "cold", "warm", "touch" ):
+        for phase in sorted(results[scenario], key = lambda p: (p == "run", p)):
+            times = results[scenario][phase]
+            line = "%-6s %-10s %9.2fs %9.2fs" % (scenario, phase, times["wall"], times["cpu"])
+            old = baseline and baseline.get(scenario, {}).get(phase)
+            if old:
+                change = 0.0
+                if old["wall"] > 0:
+                    change = (times["wall"] - old["wall"]) * 100.0 / old["wall"]
+                line += "  %9.2fs %+6.1f%%" % (old["wall"], change)
+                # tiny phases (skipped ones) are too noisy to count
+                if change > threshold and times["wall"] - old["wall"] > 0.05:
+                    line += "  REGRESSION"
+                    regressions += 1
+            print(line)
+    return regressions
+
+
+def main():
+    try:
+        opts, args = gnu_getopt(sys.argv[1:], "hn:s:d:r:o:c:t:k", ["help", "projects=", "size=", "deps=", "runs=", "seed=",
+                                                                   "output=", "compare=", "threshold=", "keep"])
+    except GetoptError, exc:
+        print("Error parsing options: '%s'" % str(exc))
+        return 1
+
+    params = { "projects" : 10, "size" : 10, "deps" : 2, "seed" : 0 }
+    runs = 3
+    output = None
+    compare = None
+    threshold = 10.0
+    keep = False
+
+    for opt in opts:
+        try:
+            if opt[0] == "-n" or opt[0] == "--projects":
+                params["projects"] = int(opt[1])
+            elif opt[0] == "-s" or opt[0] == "--size":
+                params["size"] = int(opt[1])
+            elif opt[0] == "-d" or opt[0] == "--deps":
+                params["deps"] = int(opt[1])
+            elif opt[0] == "--seed":
+                params["seed"] = int(opt[1])
+            elif opt[0] == "-r" or opt[0] == "--runs":
+                runs = int(opt[1])
+            elif opt[0] == "-t" or opt[0] == "--threshold":
+                threshold = float(opt[1])
+            elif opt[0] == "-o" or opt[0] == "--output":
+                output = opt[1]
+            elif opt[0] == "-c" or opt[0] == "--compare":
+                compare = opt[1]
+            elif opt[0] == "-k" or opt[0] == "--keep":
+                keep = True
+            elif opt[0] == "-h" or opt[0] == "--help":
+                usage()
+                return 1
+            else:
+                print("Error: unhandled option %s" % opt[0])
+                return 1
+        except ValueError:
+            print("Error: invalid value '%s' for option %s" % (opt[1], opt[0]))
+            return 1
+
+    if params["projects"] < 1 or params["size"] < 1 or runs < 1:
+        print("Error: need at least one project, source file and run")
+        return 1
+
+    baseline = None
+    if compare:
+        data = prepscript.read_stamp(compare)
+        if data is None:
+            print("Error: could not read results to compare with from '%s'" % compare)
+            return 1
+        if data["params"] != params or data["args"] != args:
+            print("Warning: '%s' was done with different settings (%s, prepscript %s)" % (compare, data["params"], ' '.join(data["args"])))
+        baseline = data["results"]
+
+    print("Info: %(projects)d projects of size %(size)d with up to %(deps)d dependencies" % params)
+    results = run_scenarios(params, args, runs, keep)
+    if results is None:
+        return 1
+
+    regressions = report(results, baseline, threshold)
+    if output:
+        prepscript.write_stamp(output, { "params" : params, "args" : args, "results" : results })
+        print("Info: results written to %s" % output)
+    if regressions:
+        print("Error: %d regressions compared to %s" % (regressions, compare))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
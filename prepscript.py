@@ -2,8 +2,23 @@
 
 import os
 import sys
+import time
+import json
+import hashlib
+import re
+import fcntl
+import shutil
+import threading
+import subprocess
+import errno
+import shlex
+import pipes
+import Queue
+from ConfigParser import RawConfigParser, Error as ConfigParserError
 from getopt import gnu_getopt, GetoptError
 
+from phasetrace import tracer, command_name
+
 
 def usage():
     print("Usage: %s <projectA> [<projectB>] [<options>]" % (os.path.basename(sys.argv[0])))
@@ -17,6 +32,19 @@ def usage():
     print("       as options to configure (all lines concatenated except for those starting with '#'")
     print("       to allow comments)")
     print("")
+    print("       bootstrapping is skipped if configure exists and none of configure.ac, the Makefile.am files,")
+    print("       m4/ or the bootstrap script changed since the last bootstrap (content hashes in .prepscript/)")
+    print("")
+    print("       configure is skipped if its command line and the configure script did not change since the")
+    print("       last run, if only the configure script changed config.status --recheck is used instead")
+    print("")
+    print("       the output of all commands is also written to .prepscript/<proj>.log and the wall and cpu")
+    print("       time of every phase to .prepscript/summary.json")
+    print("")
+    print("       dependencies between the projects are also found from the pkg-config modules they install")
+    print("       (*.pc.in, *.pc in the build dir) and need (PKG_CHECK_MODULES etc. in configure.ac), the")
+    print("       resulting graph is kept in .prepscript/depgraph.json")
+    print("")
     print("       configure is also called with LD_LIBRARY_PATH and PKG_CONFIG_PATH set to the correct")
     print("       prefix directories just in case some tools need them set up during configure")
     print("")
@@ -30,91 +58,1142 @@ def usage():
     print("")
     print("         --no-configureenvs")
     print("           do not add variables to configure for projects that feature non-autoconf based configure scripts")
+    print("")
+    print("         -j,--jobs <n>")
+    print("           set up up to <n> projects at the same time (default 1), a project is only started once")
+    print("           all projects it depends on are finished")
+    print("")
+    print("         -b,--build")
+    print("           also build the projects and install them into the prefix, all make runs share one jobserver")
+    print("           so there are never more than -j jobs in total. projects that did not change since their last")
+    print("           install (and that do not depend on a project rebuilt in this run) are skipped")
+    print("")
+    print("         -l,--load-average <load>")
+    print("           do not start new projects or make jobs while the load average is at or above <load>")
+    print("")
+    print("         -r,--rebuild-downstream <proj>")
+    print("           reconfigure (and rebuild with -b) <proj> and only the projects that depend on it, if no projects")
+    print("           are given all projects of earlier runs are considered")
+    print("")
+    print("         -C,--ccache")
+    print("           compile through ccache with a cache dir for the whole workspace (.prepscript/ccache), CC and CXX")
+    print("           for configure are set to wrappers for that and the hits and misses of each project are")
+    print("           reported at the end of a run (this needs ccache 4.5 or later)")
+    print("")
+    print("         -c,--shared-cache")
+    print("           let all projects share one autoconf cache (.prepscript/config.cache) so checks done by one")
+    print("           configure are not repeated by the next, it is reset when the compiler or CFLAGS etc. change")
+    print("           and cleared of prefix dependent results when the pkgconfig files in the prefix change,")
+    print("           projects passing CC=, CFLAGS=, --host= etc. to configure share one per set of these options")
+    print("")
+    print("         -d,--depends <proj>:<dep>[,<dep>...]")
+    print("           declare that <proj> needs the listed projects to be set up first (may be repeated)")
+    print("")
+    print("         -m,--manifest <file>")
+    print("           read the workspace setup from an ini style file with one section per project, e.g.")
+    print("             [prepscript]")
+    print("             prefix = prefix                  # these are the defaults")
+    print("             sourcedir = git_{project}")
+    print("             builddir = build_{project}")
+    print("             jobs = 1                         # used if -j is not given")
+    print("             ccache = no                      # used if -C is not given")
+    print("             tmpfs =                          # used if -T is not given, also tmpfsbudget")
+    print("             [vlc]")
+    print("             depends = libav x264")
+    print("             options = --disable-lua          # used instead of vlc.conf")
+    print("             sourcetreebuild = no             # also configureenvs, sourcedir, builddir")
+    print("           if no projects are given on the command line, all sections are used in file order")
+    print("")
+    print("         --resume")
+    print("           skip the phases that finished in earlier runs according to .prepscript/journal.json, e.g.")
+    print("           to continue after a failure without checking everything that was done before again")
+    print("")
+    print("         -T,--tmpfs <dir>")
+    print("           put the build dirs in <dir> (a tmpfs like /dev/shm) instead of next to the sources, only")
+    print("           config.status and config.log are copied back to build_<proj> when a project is finished.")
+    print("           the prefix stays where it is. if the build dir was lost (e.g. after a reboot) it is set up")
+    print("           again from the saved config.status instead of running configure")
+    print("")
+    print("         --tmpfs-budget <MB>")
+    print("           space the build dirs may use on the tmpfs (default half of its size), the build dirs of")
+    print("           projects finished earlier are removed from it to stay below that")
+    print("")
+    print("         --trace <file>")
+    print("           record how long every phase, command and file operation took, write it to <file> as Chrome")
+    print("           trace events (for chrome://tracing or ui.perfetto.dev) and print a summary at the end")
+
 
 
+STATEDIR = '.prepscript' # per workspace state (logs, stamps etc.), relative to the current directory
+BOOTSTRAPNAMES = [ "bootstrap", "autogen.sh" ]
+SYNCNAMES = [ "config.status", "config.log" ] # copied back from build dirs on tmpfs
+
+
+_popenlock = threading.Lock()
+_consolelock = threading.Lock()
+
+
+def popen(*args, **kwargs):
+    '''
+        subprocess.Popen that is safe to use from several threads: our end of the
+        pipes is made close-on-exec before any other child can be forked, else a
+        child started at the same time would inherit it and keep it open
+    '''
+    with _popenlock:
+        p = subprocess.Popen(*args, **kwargs)
+        for fh in (p.stdin, p.stdout, p.stderr):
+            if fh:
+                flags = fcntl.fcntl(fh.fileno(), fcntl.F_GETFD)
+                fcntl.fcntl(fh.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return p
+
+
+def run_command(cmdline, cwd = None, env = None, logfile = None, outputprefix = ""):
+    '''
+        run a shell command line, passing its output on line by line to the console
+        (each line prepended with outputprefix) and to the log file.
+        returns { "command", "status", "wall", "cpu" } with the times in seconds,
+        status is the exit code or the negative signal number
+    '''
+    with tracer.span(command_name(cmdline), "command", command = cmdline, cwd = cwd):
+        return _run_command(cmdline, cwd, env, logfile, outputprefix)
+
+
+def _run_command(cmdline, cwd, env, logfile, outputprefix):
+    starttime = time.time()
+    logfh = None
+    if logfile:
+        logfh = open(logfile, "a")
+        logfh.write("+ %s\n" % cmdline)
+        logfh.flush()
+    try:
+        p = popen(cmdline, shell = True, cwd = cwd, env = env, bufsize = -1, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        for line in iter(p.stdout.readline, ""):
+            with _consolelock:
+                sys.stdout.write(outputprefix + line)
+                sys.stdout.flush()
+            if logfh:
+                logfh.write(line)
+        p.stdout.close()
+        # wait4 instead of p.wait() to get the cpu time used by the command and its children
+        pid, status, rusage = os.wait4(p.pid, 0)
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        result = { "command" : cmdline,
+                   "status"  : p.returncode,
+                   "wall"    : time.time() - starttime,
+                   "cpu"     : rusage.ru_utime + rusage.ru_stime }
+        if logfh:
+            logfh.write("+ status %d after %.1fs (%.1fs cpu)\n" % (result["status"], result["wall"], result["cpu"]))
+    finally:
+        if logfh:
+            logfh.close()
+    return result
+
+
+class JobServer:
+    '''
+        GNU make jobserver shared by all make runs so their jobs together stay
+        within the given limit. every make run needs one token for itself (the one
+        make assumes it has implicitly) which is taken with acquire() before it is
+        started and given back with release() afterwards.
+    '''
+    def __init__(self, jobs, loadaverage = None):
+        self.jobs = jobs
+        self.loadaverage = loadaverage
+        self.readfd, self.writefd = os.pipe() # inherited by all children
+        os.write(self.writefd, "+" * jobs)
+
+    def acquire(self):
+        while True:
+            try:
+                return os.read(self.readfd, 1)
+            except OSError, exc:
+                if exc.errno != errno.EINTR:
+                    raise
+
+    def release(self, token = "+"):
+        os.write(self.writefd, token)
+
+    def makeflags(self):
+        # --jobserver-fds is understood by old makes and still accepted by new ones
+        flags = " -j --jobserver-fds=%d,%d" % (self.readfd, self.writefd)
+        if self.loadaverage:
+            flags += " -l %s" % self.loadaverage
+        return flags
+
+
+class Journal:
+    '''
+        records which phases of which projects finished (or failed), so a run that
+        stopped half way can be resumed without going through the finished ones again
+    '''
+    def __init__(self, fname, resume):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.data = None
+        if resume:
+            self.data = read_stamp(fname)
+        if self.data is None:
+            self.data = { "projects" : {} }
+
+    def done(self, project, phase):
+        with self.lock:
+            return self.data["projects"].get(project, {}).get(phase) == "done"
+
+    def record(self, project, phase, success):
+        with self.lock:
+            self.data["projects"].setdefault(project, {})[phase] = "done" if success else "failed"
+            write_stamp(self.fname, self.data)
+
+
+class CompilerCache:
+    '''
+        ccache with one cache dir for the whole workspace. every project gets its own
+        compiler wrapper scripts (so CC and CXX saved in config.status keep working when
+        building by hand) which also make ccache log the result of each compilation to
+        a per project file for the statistics (needs ccache 4.5 or later)
+    '''
+    def __init__(self, ccache):
+        self.ccache = ccache
+        self.basedir = os.path.abspath(os.path.join(STATEDIR, "ccache"))
+        self.cachedir = os.path.join(self.basedir, "cache")
+
+    def statslog(self, project):
+        return os.path.join(self.basedir, "%s.stats" % project)
+
+    def wrappers(self, project, cc = None, cxx = None):
+        '''
+            create the wrappers for the project around the given compilers (default CC and
+            CXX of the environment), returns the paths of the C and C++ ones
+        '''
+        wrapperdir = os.path.join(self.basedir, "wrappers", project)
+        if not os.path.exists(wrapperdir):
+            os.makedirs(wrapperdir)
+        paths = []
+        for name, compiler in ( ("cc", cc or os.environ.get("CC", "cc")), ("c++", cxx or os.environ.get("CXX", "c++")) ):
+            path = os.path.join(wrapperdir, name)
+            with open(path + ".tmp", "w") as fh:
+                fh.write("#!/bin/sh\n")
+                fh.write("# generated by prepscript\n")
+                fh.write("CCACHE_DIR='%s' CCACHE_STATSLOG='%s'\n" % (self.cachedir, self.statslog(project)))
+                fh.write("export CCACHE_DIR CCACHE_STATSLOG\n")
+                fh.write("exec '%s' %s \"$@\"\n" % (self.ccache, compiler))
+            os.chmod(path + ".tmp", 0755)
+            os.rename(path + ".tmp", path)
+            paths.append(path)
+        return tuple(paths)
+
+    def reset_stats(self, project):
+        if os.path.exists(self.statslog(project)):
+            os.remove(self.statslog(project))
+
+    HITCOUNTERS = ( "direct_cache_hit", "preprocessed_cache_hit" )
+    MISSCOUNTERS = ( "cache_miss", )
+
+    def stats(self, project):
+        '''
+            { "hits", "misses", "uncacheable" } of the compilations since reset_stats().
+            the log has a "# <file>" line for every call followed by its counters, calls
+            with neither a hit nor a miss counter count as uncacheable (links, -E, ...)
+        '''
+        result = { "hits" : 0, "misses" : 0, "uncacheable" : 0 }
+        def count(counters):
+            if counters is None:
+                return
+            if counters & set(self.HITCOUNTERS):
+                result["hits"] += 1
+            elif counters & set(self.MISSCOUNTERS):
+                result["misses"] += 1
+            else:
+                result["uncacheable"] += 1
+        if os.path.exists(self.statslog(project)):
+            counters = None
+            with open(self.statslog(project), "r") as fh:
+                for l in fh:
+                    l = l.strip()
+                    if l.startswith('#'):
+                        count(counters)
+                        counters = set()
+                    elif l and counters is not None:
+                        counters.add(l)
+            count(counters)
+        return result
+
+
+class TmpfsBuilds:
+    '''
+        build dirs on a tmpfs (in a directory of their own for the workspace so they
+        are found again by later runs) kept within a budget: before a project starts,
+        the build dirs of projects that finished longest ago (or that are not part of
+        this run) are removed until the others use less than the budget
+    '''
+    def __init__(self, tmpfsdir, budget = None):
+        workspace = hashlib.sha1(os.path.abspath(os.getcwd())).hexdigest()[:12]
+        self.root = os.path.join(os.path.abspath(tmpfsdir), "prepscript-%s" % workspace)
+        if budget is None:
+            st = os.statvfs(tmpfsdir)
+            budget = st.f_blocks * st.f_frsize // 2
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.planned = set()    # build dirs of all projects of this run
+        self.finished = []      # build dirs of projects finished in this run, oldest first
+
+    def buildpath(self, project):
+        return os.path.join(self.root, "build_%s" % project)
+
+    def usage(self, path = None):
+        '''
+            bytes used in a build dir (or all of them)
+        '''
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path or self.root):
+            for f in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, f)).st_blocks * 512
+                except OSError:
+                    pass # vanished while looking
+        return total
+
+    def start(self, buildpath):
+        '''
+            make room for a project about to be set up
+        '''
+        with self.lock:
+            used = self.usage()
+            leftovers = [ os.path.join(self.root, d) for d in sorted(os.listdir(self.root)) ]
+            candidates = [ d for d in leftovers if d not in self.planned ] + self.finished
+            while used > self.budget and candidates:
+                path = candidates.pop(0)
+                size = self.usage(path)
+                print("Info: removing %s from %s to stay within %dMB" % (os.path.basename(path), self.root, self.budget >> 20))
+                shutil.rmtree(path, True)
+                if path in self.finished:
+                    self.finished.remove(path)
+                used -= size
+            if used > self.budget:
+                print("Warning: build dirs in %s use %dMB, more than the budget of %dMB" % (self.root, (used + (1 << 20) - 1) >> 20, self.budget >> 20))
+            if not os.path.exists(buildpath):
+                os.makedirs(buildpath)
+
+    def finish(self, buildpath, syncpath):
+        '''
+            copy the results worth keeping of a finished project back to disk
+        '''
+        with tracer.span("sync build dir", "file"):
+            for name in SYNCNAMES:
+                src = os.path.join(buildpath, name)
+                if os.path.exists(src):
+                    shutil.copy2(src, os.path.join(syncpath, name + ".tmp"))
+                    os.rename(os.path.join(syncpath, name + ".tmp"), os.path.join(syncpath, name))
+        with self.lock:
+            self.finished.append(buildpath)
+
 
 class RepoPrep:
-    def __init__(self, projectname, repopath, buildpath, prefixpath, addconfigureenvs):
+    def __init__(self, projectname, repopath, buildpath, prefixpath, addconfigureenvs, logfile = None, sharedcache = False, outputprefix = "", jobserver = None, force = False, options = None, journal = None, compilercache = None, tmpfs = None, syncpath = None):
         self.projectname = projectname # just a fancy name
         self.repopath    = repopath    # where to find the repository for configuring
         self.buildpath   = buildpath   # where to build (can be same as repopath)
         self.prefixpath  = prefixpath  # root prefix where to put the result
         self.addconfenv  = addconfigureenvs # if True, add configure environment variables for prefix
+        self.logfile     = logfile     # if set, the output of all commands also goes here
+        self.sharedcache = sharedcache # if True, use the autoconf cache shared by all projects in the prefix
+        self.outputprefix = outputprefix # prepended to the console output of commands
+        self.jobserver   = jobserver   # if set, also build and install the project using this jobserver
+        self.force       = force       # if True, configure (and build) even if nothing seems to have changed
+        self.options     = options     # configure options, if None they are read from <project>.conf
+        self.journal     = journal     # if set, phases already done according to it are skipped
+        self.compilercache = compilercache # if set, compile through this CompilerCache
+        self.tmpfs       = tmpfs       # if set, the TmpfsBuilds the build dir is part of
+        self.syncpath    = syncpath    # build dir on disk the results are copied back to (with tmpfs)
+        self.phases      = []          # timing of all phases run so far (see timed())
+        self.changed     = False       # True once the project was (re)built and installed
+        self.upstreamchanged = False   # True if a project this one depends on was rebuilt in this run
+
+    def run(self, cmdline, cwd = None, env = None):
+        '''
+            run a shell command line for the current phase, returns its status
+        '''
+        result = run_command(cmdline, cwd, env, self.logfile, self.outputprefix)
+        if self.phases:
+            self.phases[-1]["commands"].append(result)
+        return result["status"]
+
+    def stampfile(self, phase):
+        return os.path.join(STATEDIR, "%s.%s" % (self.projectname, phase))
+
+    @tracer.traced("find bootstrap inputs", "file")
+    def bootstrap_inputs(self):
+        '''
+            relative paths of all files that bootstrapping depends on: configure.ac,
+            all Makefile.am, everything in m4/ and the bootstrap script itself
+        '''
+        inputs = []
+        for name in [ "configure.ac", "configure.in" ] + BOOTSTRAPNAMES:
+            if os.path.isfile(os.path.join(self.repopath, name)):
+                inputs.append(name)
+        for dirpath, dirnames, filenames in os.walk(self.repopath):
+            dirnames[:] = [ d for d in dirnames if not d.startswith('.') ]
+            reldir = os.path.relpath(dirpath, self.repopath)
+            inm4 = reldir == "m4" or reldir.startswith("m4" + os.sep)
+            for f in filenames:
+                if inm4 or f.endswith(".am"):
+                    inputs.append(os.path.normpath(os.path.join(reldir, f)))
+        return sorted(inputs)
 
     def prepare(self):
         '''
-            requires either a "bootstrap" or "autoconf.sh" script
+            bootstrap and configure the project (and build and install it if we have
+            a jobserver), returns 0 on success
         '''
-          
-        # bootstrap
-        conffile = os.path.abspath(os.path.join(self.repopath, 'configure'))
-        if not os.path.exists(conffile):
-            bootstrapnames = [ "bootstrap", "autogen.sh" ]
-            bootstrapfile = None
-            for name in bootstrapnames:
-                chkpath = os.path.abspath(os.path.join(self.repopath, name))
-                if os.path.exists(chkpath):
-                    bootstrapfile = chkpath
-                    break
-   
-            print "Info: %s needs bootstrap" % self.projectname
-            if not bootstrapfile:
-                print("Info: no '%s' configure file found but no bootstrap file (%s) either, trying to call autoconfig directly" % (conffile, ', '.join(bootstrapnames)))
-                retval = os.system("cd %s && autoreconf -fis" % self.repopath)
-                if retval != 0:
-                    print("Error: autoreconf returned status %d" % retval)
-                    return 1
+        with tracer.span(self.projectname, "project"):
+            if not self.tmpfs:
+                return self._prepare()
+            self.tmpfs.start(self.buildpath)
+            try:
+                return self._prepare()
+            finally:
+                self.tmpfs.finish(self.buildpath, self.syncpath)
+
+    def _prepare(self):
+        if self.compilercache:
+            self.compilercache.reset_stats(self.projectname)
+        if self.jobserver:
+            # the token of this project, used by the make runs as their implicit one
+            token = self.jobserver.acquire()
+        try:
+            res = self.timed("bootstrap", self.bootstrap)
+            if res != 0:
+                return res
+            res = self.timed("configure", self.configure)
+            if res != 0:
+                return res
+            if not self.jobserver:
+                print("Info: finished setting up %s, cd to %s for building\n" % (self.projectname, self.buildpath))
+                return 0
+            res = self.timed("build", self.build)
+            if res != 0:
+                return res
+            print("Info: finished building %s and installing it to %s\n" % (self.projectname, self.prefixpath))
+            return 0
+        finally:
+            if self.jobserver:
+                self.jobserver.release(token)
+
+    def timed(self, phase, func):
+        '''
+            run one phase and record its timing (wall time of the whole phase,
+            cpu time of the commands it ran)
+        '''
+        entry = { "name" : phase, "commands" : [] }
+        self.phases.append(entry)
+        starttime = time.time()
+        with tracer.span(phase, "phase", project = self.projectname):
+            if self.journal and self.journal.done(self.projectname, phase):
+                print("Info: %s of %s was done in an earlier run" % (phase, self.projectname))
+                res = 0
             else:
-                # silly trick to keep configure from running through autogen.sh since we prefer out-of-source builds
-                bootstrapenvs = "AUTOGEN_CONFIGURE_ARGS=\"--version\""
-    
-                cmdline = "export %s && cd %s && %s noconfig" % (bootstrapenvs, self.repopath, bootstrapfile)
-                print cmdline
-                retval = os.system(cmdline)
-                if retval != 0:
-                    print("Error: bootstrapping %s returned status %d" % (self.projectname, retval))
-                    return 1
+                res = func()
+                if self.journal:
+                    self.journal.record(self.projectname, phase, res == 0)
+        entry["wall"] = time.time() - starttime
+        entry["cpu"] = sum(c["cpu"] for c in entry["commands"])
+        entry["status"] = res
+        entry["skipped"] = len(entry["commands"]) == 0
+        print("Info: %s phase of %s %s %.1fs (%.1fs cpu)" % (phase, self.projectname,
+            "skipped after" if entry["skipped"] else "took", entry["wall"], entry["cpu"]))
+        return res
+
+    def bootstrap(self):
+        '''
+            requires either a "bootstrap" or "autoconf.sh" script, else autoreconf is called.
+            only runs if there is no configure script yet or if one of the bootstrap inputs
+            changed since the last time (tracked by content hashes in a stamp file)
+        '''
+        conffile = os.path.abspath(os.path.join(self.repopath, 'configure'))
+        stampfile = self.stampfile("bootstrap")
+        stamp = read_stamp(stampfile)
+        hashes = hash_files(self.repopath, self.bootstrap_inputs(), stamp)
+        if os.path.exists(conffile):
+            if stamp is None:
+                # bootstrapped before we kept stamps, take it as it is
+                write_stamp(stampfile, hashes)
+                print("Info: %s is already bootstrapped" % self.projectname)
+                return 0
+            if same_hashes(stamp, hashes):
+                print("Info: %s is already bootstrapped" % self.projectname)
+                return 0
+            print("Info: bootstrap inputs of %s changed" % self.projectname)
+
+        bootstrapfile = None
+        for name in BOOTSTRAPNAMES:
+            chkpath = os.path.abspath(os.path.join(self.repopath, name))
+            if os.path.exists(chkpath):
+                bootstrapfile = chkpath
+                break
+
+        print "Info: %s needs bootstrap" % self.projectname
+        # a failed bootstrap may leave a configure script behind, an empty stamp
+        # makes sure the next run does not take that as a finished bootstrap
+        write_stamp(stampfile, {})
+        if not bootstrapfile:
+            print("Info: no bootstrap file (%s) found, trying to call autoconfig directly" % ', '.join(BOOTSTRAPNAMES))
+            retval = self.run("autoreconf -fis", cwd = self.repopath)
+            if retval != 0:
+                print("Error: autoreconf returned status %d" % retval)
+                return 1
         else:
-            print("Info: %s is already bootstrapped" % self.projectname)
-    
-        # configure
-        print("Info: configuring %s" % self.projectname)
-        
+            # silly trick to keep configure from running through autogen.sh since we prefer out-of-source builds
+            bootstrapenvs = dict(os.environ, AUTOGEN_CONFIGURE_ARGS = "--version")
+
+            cmdline = "%s noconfig" % bootstrapfile
+            print cmdline
+            retval = self.run(cmdline, cwd = self.repopath, env = bootstrapenvs)
+            if retval != 0:
+                print("Error: bootstrapping %s returned status %d" % (self.projectname, retval))
+                return 1
+
+        # bootstrapping may add files to m4/ itself, so hash again
+        write_stamp(stampfile, hash_files(self.repopath, self.bootstrap_inputs(), hashes))
+        return 0
+
+    def configure(self):
+        '''
+            configures the project in the build dir. the command line used is remembered so
+            configure is skipped if neither it nor the configure script changed since the
+            last successful run. if only the configure script changed (e.g. after a new
+            bootstrap) config.status --recheck is used to rerun it with the same options.
+        '''
+        conffile = os.path.abspath(os.path.join(self.repopath, 'configure'))
+
+        configureoptions = self.options
+        if configureoptions is None:
+            configureoptions = get_options(self.projectname)
+        # the shared autoconf cache goes by the compiler the project asked for, not the wrapper
+        cacheoptions = configureoptions
+
         # set path environment variable for configure (they get saved in config.status for reruns)
         envs = ""
         if self.addconfenv:
             envs = "LD_LIBRARY_PATH=%s/lib PKG_CONFIG_PATH=%s/lib/pkgconfig" % (self.prefixpath, self.prefixpath)
-            configureoptions = get_options(self.projectname)
-           
-            cmdline = "cd %s && %s --prefix=%s %s %s" % (self.buildpath, conffile, self.prefixpath, configureoptions, envs)
+            if self.compilercache:
+                # wrap the compilers set in the project's options, configure takes the last
+                # CC= and CXX= so those of the project are dropped in favour of the wrappers
+                assigned = dict(a.split("=", 1) for a in AutoconfCache.toolchain_options(configureoptions) if not a.startswith("-"))
+                envs += " CC=%s CXX=%s" % self.compilercache.wrappers(self.projectname, assigned.get("CC"), assigned.get("CXX"))
+                if "CC" in assigned or "CXX" in assigned:
+                    configureoptions = ' '.join(pipes.quote(arg) for arg in split_options(configureoptions)
+                                                if arg.split("=", 1)[0] not in ( "CC", "CXX" ))
+        cacheopt = ""
+        if self.sharedcache and self.addconfenv:
+            cacheopt = "--cache-file=config.cache"
+        confcmd = "%s --prefix=%s %s %s %s" % (conffile, self.prefixpath, cacheopt, configureoptions, envs)
+
+        stampfile = self.stampfile("configure")
+        stamp = read_stamp(stampfile)
+        scripthash = hash_files(self.repopath, [ "configure" ], stamp and stamp.get("script"))
+        configstatus = os.path.join(self.buildpath, "config.status")
+        if self.syncpath and not os.path.exists(configstatus) and stamp and stamp.get("cmdline") == confcmd:
+            self.restore_buildpath()
+
+        fullconfigure = self.force or stamp is None or not os.path.exists(configstatus) or stamp.get("cmdline") != confcmd
+        if not fullconfigure and same_hashes(stamp["script"], scripthash):
+            print("Info: %s is already configured with the same options" % self.projectname)
+            return 0
+
+        if cacheopt:
+            cache = AutoconfCache(self.prefixpath, cacheoptions)
+            cache.checkout(os.path.join(self.buildpath, "config.cache"))
+
+        if fullconfigure:
+            retval = self.full_configure(confcmd)
+        else:
+            print("Info: configure script of %s changed, rechecking" % self.projectname)
+            cmdline = "./config.status --recheck && ./config.status"
             print cmdline
-            retval = os.system(cmdline)
+            retval = self.run(cmdline, cwd = self.buildpath)
+            if retval != 0:
+                print("Info: rechecking %s returned status %d, trying a full configure" % (self.projectname, retval))
+                retval = self.full_configure(confcmd)
+        if retval != 0:
+            # make sure the next run does not take a half configured build dir as finished
+            if os.path.exists(stampfile):
+                os.remove(stampfile)
+            return 1
+
+        write_stamp(stampfile, { "cmdline" : confcmd, "script" : scripthash })
+        if cacheopt:
+            cache.checkin(os.path.join(self.buildpath, "config.cache"))
+        return 0
+
+    def restore_buildpath(self):
+        '''
+            set up a lost build dir on tmpfs again from the config.status saved on disk
+            (cheaper than running configure), returns True on success
+        '''
+        saved = os.path.join(self.syncpath, "config.status")
+        if not os.path.exists(saved):
+            return False
+        print("Info: build dir of %s is gone, setting it up again from %s" % (self.projectname, saved))
+        configstatus = os.path.join(self.buildpath, "config.status")
+        shutil.copy2(saved, configstatus)
+        if self.run("./config.status", cwd = self.buildpath) != 0:
+            print("Info: %s did not work, configuring %s again" % (saved, self.projectname))
+            os.remove(configstatus)
+            return False
+        return True
+
+    def build_uptodate(self, stampfile):
+        '''
+            True if nothing was changed in the source or build dir since the last
+            successful install and neither this project nor one it depends on got
+            reconfigured or rebuilt in this run
+        '''
+        if self.force or self.upstreamchanged or not os.path.exists(stampfile):
+            return False
+        if not [ p for p in self.phases if p["name"] == "configure" and p["skipped"] ]:
+            return False
+        stamptime = os.stat(stampfile).st_mtime
+        for tree in set([ self.repopath, self.buildpath ]):
+            for dirpath, dirnames, filenames in os.walk(tree):
+                dirnames[:] = [ d for d in dirnames if not d.startswith('.') ]
+                for f in filenames:
+                    try:
+                        if os.lstat(os.path.join(dirpath, f)).st_mtime > stamptime:
+                            return False
+                    except OSError:
+                        pass # vanished while looking
+        return True
+
+    def build(self):
+        '''
+            make and make install in the build dir, all make runs share the jobserver
+        '''
+        stampfile = self.stampfile("build")
+        if self.build_uptodate(stampfile):
+            print("Info: %s is already built and installed" % self.projectname)
+            return 0
+        if os.path.exists(stampfile):
+            os.remove(stampfile)
+
+        makeenvs = dict(os.environ, MAKEFLAGS = self.jobserver.makeflags())
+        for cmdline in ( "make", "make install" ):
+            print("Info: %s in %s" % (cmdline, self.buildpath))
+            retval = self.run(cmdline, cwd = self.buildpath, env = makeenvs)
             if retval != 0:
-                print("Error: configuring %s returned status %d" % (self.projectname, retval))
+                print("Error: '%s' for %s returned status %d" % (cmdline, self.projectname, retval))
                 return 1
-            print("Info: finished setting up %s, cd to %s for building\n" % (self.projectname, self.buildpath))
+        self.changed = True
+        write_stamp(stampfile, { "prefix" : self.prefixpath })
+        return 0
+
+    def full_configure(self, confcmd):
+        print("Info: configuring %s" % self.projectname)
+        print confcmd
+        retval = self.run(confcmd, cwd = self.buildpath)
+        if retval != 0:
+            print("Error: configuring %s returned status %d" % (self.projectname, retval))
+        return retval
+
+
+class AutoconfCache:
+    '''
+        autoconf result cache shared by all projects using the same prefix.
+        every project configures with a private copy of it (so concurrent configure
+        runs never write the same file) whose results get merged back afterwards.
+
+        the cache is tied to the compiler, the compiler flags and the contents of
+        prefix/lib/pkgconfig. if the compiler or flags change it is thrown away,
+        if only the pkgconfig files change the results that can depend on what is
+        installed in the prefix are dropped. projects whose configure options set
+        variables (CC=, CFLAGS=, ...) or --host/--build/--target get a cache of their
+        own for each distinct set of these options.
+    '''
+    # results that can change when something gets installed into the prefix
+    PREFIXDEPENDENT = ( "pkg_cv_", "ac_cv_lib_", "ac_cv_header_", "ac_cv_search_", "ac_cv_func_" )
+    TOOLCHAINVARS = ( "CC", "CXX", "CPP", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS", "LIBS" )
+    CACHELINE = re.compile(r'''^(?:test "\$\{(\w+)\+set\}" = set \|\| )?(\w+)=''')
 
+    SYSTEMOPTIONS = ( "--host", "--build", "--target" )
 
+    def __init__(self, prefixpath, configureoptions = ""):
+        self.prefixpath = prefixpath
+        self.variant = self.toolchain_options(configureoptions)
+        name = "config.cache"
+        if self.variant:
+            name += "." + hashlib.sha1("\n".join(self.variant)).hexdigest()[:12]
+        self.cachefile  = os.path.join(STATEDIR, name)
+        self.idfile     = os.path.join(STATEDIR, name + ".id")
+        self.lockfile   = os.path.join(STATEDIR, name + ".lock")
 
-def main():
-    if len(sys.argv) < 2:
+    @classmethod
+    def toolchain_options(cls, configureoptions):
+        '''
+            the configure options that change the results of the checks: variable
+            assignments (configure takes them as precious variables like CC or CFLAGS)
+            and the system types, sorted so their order does not matter
+        '''
+        args = split_options(configureoptions)
+        found = []
+        for i, arg in enumerate(args):
+            if re.match(r'^[A-Za-z_]\w*=', arg):
+                found.append(arg)
+            elif arg.split("=", 1)[0] in cls.SYSTEMOPTIONS:
+                if "=" not in arg and i + 1 < len(args):
+                    arg += "=" + args[i + 1]
+                found.append(arg)
+        return sorted(found)
+
+    def toolchain_id(self):
+        assigned = dict(a.split("=", 1) for a in self.variant if not a.startswith("-"))
+        envs = [ "%s=%s" % (v, assigned.get(v, os.environ.get(v, ""))) for v in self.TOOLCHAINVARS ]
+        compilers = []
+        for cc in ( assigned.get("CC", os.environ.get("CC", "cc")), assigned.get("CXX", os.environ.get("CXX", "c++")) ):
+            try:
+                version = popen("%s --version" % cc, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT).communicate()[0]
+            except OSError:
+                version = ""
+            compilers.append("%s: %s" % (cc, version.strip()))
+        return hashlib.sha1("\n".join(envs + compilers)).hexdigest()
+
+    def pkgconfig_id(self):
+        pcdir = os.path.join(self.prefixpath, "lib", "pkgconfig")
+        if not os.path.isdir(pcdir):
+            return ""
+        return content_id(hash_files(pcdir, sorted(os.listdir(pcdir))))
+
+    def locked(self):
+        fh = open(self.lockfile, "a")
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh # the lock is released by closing this
+
+    def read(self, fname):
+        '''
+            returns the cache lines by variable name (keeping their order)
+        '''
+        entries = []
+        if os.path.exists(fname):
+            with open(fname, "r") as fh:
+                for l in fh:
+                    m = self.CACHELINE.match(l)
+                    if m:
+                        entries.append((m.group(1) or m.group(2), l))
+        return entries
+
+    def write(self, fname, entries):
+        tmpname = fname + ".tmp"
+        with open(tmpname, "w") as fh:
+            fh.write("# autoconf cache shared by the projects set up by prepscript\n")
+            for name, line in entries:
+                fh.write(line)
+        os.rename(tmpname, fname)
+
+    def validate(self):
+        '''
+            drop what is outdated in the shared cache, must be called with the lock held
+        '''
+        ids = { "toolchain" : self.toolchain_id(), "pkgconfig" : self.pkgconfig_id() }
+        old = read_stamp(self.idfile)
+        if old != ids:
+            if old is None or old.get("toolchain") != ids["toolchain"]:
+                if os.path.exists(self.cachefile):
+                    print("Info: compiler setup changed, dropping the shared autoconf cache")
+                    os.remove(self.cachefile)
+            else:
+                print("Info: pkgconfig files in the prefix changed, dropping prefix dependent autoconf results")
+                entries = [ (name, l) for name, l in self.read(self.cachefile) if not name.startswith(self.PREFIXDEPENDENT) ]
+                self.write(self.cachefile, entries)
+            write_stamp(self.idfile, ids)
+
+    @tracer.traced("autoconf cache checkout", "file")
+    def checkout(self, projectcache):
+        '''
+            replace the cache of a project with the current shared one
+        '''
+        lock = self.locked()
+        try:
+            self.validate()
+            if os.path.exists(self.cachefile):
+                shutil.copyfile(self.cachefile, projectcache)
+            elif os.path.exists(projectcache):
+                os.remove(projectcache)
+        finally:
+            lock.close()
+
+    @tracer.traced("autoconf cache checkin", "file")
+    def checkin(self, projectcache):
+        '''
+            merge the results of a finished configure run back into the shared cache
+        '''
+        lock = self.locked()
+        try:
+            self.validate()
+            entries = self.read(self.cachefile)
+            known = dict(entries)
+            for name, l in self.read(projectcache):
+                # precious variables are specific to each project and would make
+                # other configure runs fail with "... has changed since the previous run"
+                if name.startswith("ac_cv_env_"):
+                    continue
+                if name not in known:
+                    entries.append((name, l))
+                known[name] = l
+            self.write(self.cachefile, [ (name, known[name]) for name, l in entries ])
+        finally:
+            lock.close()
+
+
+def read_stamp(fname):
+    '''
+        returns the contents of a stamp file or None if there is none (or it is unusable)
+    '''
+    try:
+        with open(fname, "r") as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+@tracer.traced("write stamp", "file")
+def write_stamp(fname, data):
+    tmpname = fname + ".tmp"
+    with open(tmpname, "w") as fh:
+        json.dump(data, fh, indent = 1, sort_keys = True)
+    os.rename(tmpname, fname)
+
+
+@tracer.traced("hash files", "file")
+def hash_files(root, relpaths, previous = None):
+    '''
+        returns { relpath : [ mtime, size, sha1 ] } for the given files, the hash of
+        files whose mtime and size match the previous result is reused instead of
+        reading them again
+    '''
+    previous = previous or {}
+    result = {}
+    for rel in relpaths:
+        path = os.path.join(root, rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        old = previous.get(rel)
+        if old and old[0] == st.st_mtime and old[1] == st.st_size:
+            result[rel] = old
+            continue
+        sha = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(65536), ""):
+                sha.update(block)
+        result[rel] = [ st.st_mtime, st.st_size, sha.hexdigest() ]
+    return result
+
+
+def content_id(hashes):
+    '''
+        single hash over the content hashes of a hash_files() result
+        (so it only changes with the contents of the files)
+    '''
+    return hashlib.sha1(repr(sorted((k, v[2]) for k, v in hashes.items()))).hexdigest()
+
+
+def same_hashes(a, b):
+    '''
+        compare two hash_files() results by content only
+    '''
+    return sorted((k, v[2]) for k, v in a.items()) == sorted((k, v[2]) for k, v in b.items())
+
+
+
+def order_projects(projects, depends):
+    '''
+        sort projects so that every project comes after the ones it depends on,
+        otherwise keeping the given order. dependencies on projects that are not
+        part of this run are ignored (assumed to be set up already).
+        returns None if the dependencies are circular
+    '''
+    ordered = []
+    visiting = set()
+    def visit(proj):
+        if proj in ordered:
+            return True
+        if proj in visiting:
+            print("Error: circular dependency involving '%s'" % proj)
+            return False
+        visiting.add(proj)
+        for dep in depends.get(proj, []):
+            if dep in projects and not visit(dep):
+                return False
+        visiting.remove(proj)
+        ordered.append(proj)
+        return True
+
+    for proj in projects:
+        if not visit(proj):
+            return None
+    return ordered
+
+
+def run_projects(repos, depends, jobs, loadaverage = None):
+    '''
+        call prepare() of all repos (already in dependency order) with up to <jobs>
+        of them running at the same time. a repo is only started once everything it
+        depends on finished successfully (and, if loadaverage is given, while the load
+        is below it or nothing else is running). after the first failure no new repos
+        are started, the running ones are allowed to finish.
+    '''
+    byname = dict((repo.projectname, repo) for repo in repos)
+    names = [ repo.projectname for repo in repos ]
+    pending = list(repos)
+    running = set()
+    done = set()
+    results = Queue.Queue()
+    failed = []
+
+    def worker(repo):
+        try:
+            res = repo.prepare()
+        except Exception, exc:
+            print("Error: setting up %s failed: '%s'" % (repo.projectname, str(exc)))
+            res = 1
+        results.put((repo.projectname, res))
+
+    while pending or running:
+        throttled = False
+        if not failed:
+            for repo in list(pending):
+                if len(running) >= jobs:
+                    break
+                if running and loadaverage and os.getloadavg()[0] >= loadaverage:
+                    throttled = True
+                    break
+                deps = [ d for d in depends.get(repo.projectname, []) if d in names ]
+                if all(d in done for d in deps):
+                    print("Info: setting up %s" % repo.projectname)
+                    repo.upstreamchanged = any(byname[d].changed or byname[d].upstreamchanged for d in deps)
+                    pending.remove(repo)
+                    running.add(repo.projectname)
+                    t = threading.Thread(target = worker, args = (repo,), name = repo.projectname)
+                    t.daemon = True
+                    t.start()
+        if not running:
+            break
+        # a timeout keeps the wait interruptible by Ctrl-C
+        try:
+            name, res = results.get(True, 5 if throttled else 365 * 24 * 3600)
+        except Queue.Empty:
+            continue # look at the load again
+        running.remove(name)
+        if res != 0: # some error occurred (already reported by the class)
+            print("Error: setting up %s failed, see %s" % (name, os.path.join(STATEDIR, "%s.log" % name)))
+            failed.append(res)
+        else:
+            done.add(name)
+
+    if failed:
+        if pending:
+            print("Info: not set up because of the failure: %s" % ', '.join([ repo.projectname for repo in pending ]))
+        return failed[0]
+    return 0
+
+
+PKGMACRO = re.compile(r'''\bPKG_[A-Z_]+\(''')
+PKGWORD = re.compile(r'''[A-Za-z0-9_.+-]+''')
+
+
+def scan_pkgprovides(repopath, buildpath):
+    '''
+        names of the pkg-config modules a project installs, i.e. its *.pc.in
+        templates and the *.pc files generated in its build dir
+    '''
+    provides = set()
+    for tree, suffix in ( (repopath, ".pc.in"), (buildpath, ".pc") ):
+        for dirpath, dirnames, filenames in os.walk(tree):
+            dirnames[:] = [ d for d in dirnames if not d.startswith('.') ]
+            for f in filenames:
+                if f.endswith(suffix) and not f.endswith("-uninstalled" + suffix):
+                    provides.add(f[:-len(suffix)])
+    return provides
+
+
+def scan_pkgrequires(repopath):
+    '''
+        all words used in the arguments of PKG_* macros (PKG_CHECK_MODULES etc.) in
+        configure.ac, the module names among them are what the project needs
+    '''
+    words = set()
+    for name in ( "configure.ac", "configure.in" ):
+        fname = os.path.join(repopath, name)
+        if not os.path.exists(fname):
+            continue
+        with open(fname, "r") as fh:
+            text = fh.read()
+        for m in PKGMACRO.finditer(text):
+            # find the end of the macro call, the arguments may span lines
+            depth = 1
+            pos = m.end()
+            while depth and pos < len(text):
+                if text[pos] == '(':
+                    depth += 1
+                elif text[pos] == ')':
+                    depth -= 1
+                pos += 1
+            words.update(PKGWORD.findall(text[m.end():pos]))
+        break
+    return words
+
+
+@tracer.traced("scan pkg-config dependencies", "file")
+def update_depgraph(fname, layout):
+    '''
+        scan the projects in layout ({ proj : (repopath, buildpath) }) for the pkg-config
+        modules they provide and require and update the dependency graph stored in fname
+        with them. returns the graph as { proj : { "provides", "requires", "depends" } }
+        including the projects of earlier runs
+    '''
+    graph = read_stamp(fname) or {}
+    for proj, (repopath, buildpath) in layout.items():
+        graph[proj] = { "provides" : sorted(scan_pkgprovides(repopath, buildpath)),
+                        "words"    : sorted(scan_pkgrequires(repopath)) }
+
+    providers = {}
+    for proj, entry in graph.items():
+        for module in entry["provides"]:
+            providers.setdefault(module, set()).add(proj)
+    for proj, entry in graph.items():
+        entry["requires"] = sorted(w for w in entry["words"] if w in providers and proj not in providers[w])
+        entry["depends"] = sorted(set(p for module in entry["requires"] for p in providers[module]))
+    write_stamp(fname, graph)
+    return graph
+
+
+def downstream_projects(project, projects, depends):
+    '''
+        project and all of the given projects that (indirectly) depend on it
+    '''
+    result = set([ project ])
+    added = True
+    while added:
+        added = False
+        for proj in projects:
+            if proj not in result and result.intersection(depends.get(proj, [])):
+                result.add(proj)
+                added = True
+    return [ proj for proj in projects if proj in result ]
+
+
+MANIFESTSECTION = "prepscript" # manifest section with the settings for the whole workspace
+
+
+def read_manifest(fname):
+    '''
+        read an ini style workspace manifest, returns the parser or None on error
+    '''
+    parser = RawConfigParser()
+    try:
+        with open(fname, "r") as fh:
+            parser.readfp(fh)
+    except (IOError, ConfigParserError), exc:
+        print("Error: reading manifest '%s' : '%s'" % (fname, str(exc)))
+        return None
+    return parser
+
+
+def manifest_value(manifest, section, key, default, boolean = False):
+    '''
+        value of key in a manifest section or default if it is not set there,
+        raises ValueError for invalid booleans
+    '''
+    if manifest is None or not manifest.has_section(section) or not manifest.has_option(section, key):
+        return default
+    if boolean:
+        return manifest.getboolean(section, key)
+    return ' '.join(manifest.get(section, key).split()) # values may continue over several lines
+
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) < 1:
         usage()
         return 1
 
     try:
-        opts, args = gnu_getopt(sys.argv[1:], "sh", ["sourcetreebuild", "no-configureenvs", "help"])
+        opts, args = gnu_getopt(argv, "shj:d:m:cbl:r:CT:", ["sourcetreebuild", "no-configureenvs", "help", "jobs=", "depends=", "manifest=", "shared-cache",
+                                                         "build", "load-average=", "rebuild-downstream=", "resume", "ccache", "trace=",
+                                                         "tmpfs=", "tmpfs-budget="])
     except GetoptError, exc:
         print("Error parsing options: '%s'" % str(exc))
         return 1
     
     buildinsource = False   # defaults
     addconfigureenvs = True
+    jobs = None
+    sharedcache = False
+    ccache = None
+    build = False
+    loadaverage = None
+    rebuild = None
+    resume = False
+    depends = {}
+    manifest = None
+    tracefile = None
+    tmpfsdir = None
+    tmpfsbudget = None
 
     for opt in opts:
         if opt[0] == "-s" or opt[0] == "--sourcetreebuild":
             buildinsource = True
         elif opt[0] == '--no-configureenvs':
             addconfigureenvs = False
+        elif opt[0] == "-j" or opt[0] == "--jobs":
+            try:
+                jobs = int(opt[1])
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print("Error: invalid number of jobs '%s'" % opt[1])
+                return 1
+        elif opt[0] == "-d" or opt[0] == "--depends":
+            proj, sep, deps = opt[1].partition(':')
+            if not sep or not proj:
+                print("Error: expected <proj>:<dep>[,<dep>...] but got '%s'" % opt[1])
+                return 1
+            depends.setdefault(proj, []).extend([ d for d in deps.split(',') if d ])
+        elif opt[0] == "-r" or opt[0] == "--rebuild-downstream":
+            rebuild = opt[1]
+        elif opt[0] == "-c" or opt[0] == "--shared-cache":
+            sharedcache = True
+        elif opt[0] == "-C" or opt[0] == "--ccache":
+            ccache = True
+        elif opt[0] == "-b" or opt[0] == "--build":
+            build = True
+        elif opt[0] == "-l" or opt[0] == "--load-average":
+            try:
+                loadaverage = float(opt[1])
+            except ValueError:
+                print("Error: invalid load average '%s'" % opt[1])
+                return 1
+        elif opt[0] == "-m" or opt[0] == "--manifest":
+            manifest = read_manifest(opt[1])
+            if manifest is None:
+                return 1
+        elif opt[0] == "--resume":
+            resume = True
+        elif opt[0] == "-T" or opt[0] == "--tmpfs":
+            tmpfsdir = opt[1]
+        elif opt[0] == "--tmpfs-budget":
+            try:
+                tmpfsbudget = int(opt[1]) << 20
+            except ValueError:
+                print("Error: invalid tmpfs budget '%s'" % opt[1])
+                return 1
+        elif opt[0] == "--trace":
+            tracefile = os.path.abspath(opt[1])
+            tracer.enable()
         elif opt[0] == "-h" or opt[0] == "--help":
             usage()
             return 1
@@ -122,20 +1201,108 @@ def main():
             print("Error: unhandled option %s" % opt[0])
             return 1
 
+    if not os.path.exists(STATEDIR):
+        os.mkdir(STATEDIR)
+    graphfile = os.path.join(STATEDIR, "depgraph.json")
+
     projects = args
+    try:
+        if manifest:
+            if not projects:
+                projects = [ section for section in manifest.sections() if section != MANIFESTSECTION ]
+            for proj in manifest.sections():
+                depends.setdefault(proj, []).extend(manifest_value(manifest, proj, "depends", "").replace(',', ' ').split())
+        if not projects and rebuild:
+            # all projects we know of from earlier runs
+            projects = sorted((read_stamp(graphfile) or {}).keys())
+        if jobs is None:
+            jobs = int(manifest_value(manifest, MANIFESTSECTION, "jobs", 1))
+            if jobs < 1:
+                raise ValueError("invalid number of jobs %d" % jobs)
+        if ccache is None:
+            ccache = manifest_value(manifest, MANIFESTSECTION, "ccache", False, True)
+        if tmpfsdir is None:
+            tmpfsdir = manifest_value(manifest, MANIFESTSECTION, "tmpfs", None)
+        if tmpfsbudget is None and manifest_value(manifest, MANIFESTSECTION, "tmpfsbudget", None):
+            tmpfsbudget = int(manifest_value(manifest, MANIFESTSECTION, "tmpfsbudget", None)) << 20
+        prefix = os.path.abspath(manifest_value(manifest, MANIFESTSECTION, "prefix", "prefix"))
+        sourcedir = manifest_value(manifest, MANIFESTSECTION, "sourcedir", "git_{project}")
+        builddir = manifest_value(manifest, MANIFESTSECTION, "builddir", "build_{project}")
 
+        layout = {}
+        settings = {}
+        for proj in projects:
+            gitname = manifest_value(manifest, proj, "sourcedir", sourcedir).format(project = proj)
+            buildname = manifest_value(manifest, proj, "builddir", builddir).format(project = proj)
+            if manifest_value(manifest, proj, "sourcetreebuild", buildinsource, True):
+                buildname = gitname
+            layout[proj] = (gitname, buildname)
+            settings[proj] = { "addconfigureenvs" : manifest_value(manifest, proj, "configureenvs", addconfigureenvs, True),
+                               "options"          : manifest_value(manifest, proj, "options", None) }
+    except (ValueError, KeyError), exc:
+        print("Error: invalid setting in manifest: '%s'" % str(exc))
+        return 1
+
+    if not projects:
+        usage()
+        return 1
+
+    tmpfs = None
+    syncpaths = {}
+    if tmpfsdir:
+        if not os.path.isdir(tmpfsdir):
+            print("Error: tmpfs directory '%s' does not exist" % tmpfsdir)
+            return 1
+        tmpfs = TmpfsBuilds(tmpfsdir, tmpfsbudget)
+        if not os.path.exists(tmpfs.root):
+            os.mkdir(tmpfs.root)
+        print("Info: build dirs are in %s (budget %dMB)" % (tmpfs.root, tmpfs.budget >> 20))
+        for proj, (gitname, buildname) in layout.items():
+            if buildname != gitname:
+                syncpaths[proj] = buildname
+                layout[proj] = (gitname, tmpfs.buildpath(proj))
+                tmpfs.planned.add(tmpfs.buildpath(proj))
+
+    # add what can be found out from the pkg-config modules
+    graph = update_depgraph(graphfile, layout)
     for proj in projects:
-        gitname = 'git_' + proj
-        prefix = os.path.abspath(os.path.join(os.curdir, 'prefix'))
+        for dep in graph[proj]["depends"]:
+            if dep not in depends.get(proj, []):
+                depends.setdefault(proj, []).append(dep)
+
+    forced = set()
+    if rebuild:
+        if rebuild not in projects:
+            print("Error: project '%s' to rebuild from is not known" % rebuild)
+            return 1
+        projects = downstream_projects(rebuild, projects, depends)
+        forced = set(projects)
+        print("Info: reconfiguring %s and everything depending on it: %s" % (rebuild, ', '.join(projects)))
+
+    projects = order_projects(projects, depends)
+    if projects is None:
+        return 1
+
+    journal = Journal(os.path.join(STATEDIR, "journal.json"), resume)
+    compilercache = None
+    if ccache:
+        ccachepath = find_executable("ccache")
+        if not ccachepath:
+            print("Error: compiler cache requested but ccache was not found")
+            return 1
+        compilercache = CompilerCache(ccachepath)
+    jobserver = None
+    if build:
+        jobserver = JobServer(jobs, loadaverage)
+    repos = []
+    for proj in projects:
+        gitname, buildname = layout[proj]
         generated = [ prefix ] # generated/temporary directories
-        if buildinsource:
-            buildname = gitname
-        else:
-            buildname = 'build_' + proj
+        if buildname != gitname:
             generated.append(buildname)
+        if proj in syncpaths:
+            generated.append(syncpaths[proj])
 
-        print("Info: setting up %s" % proj)
-    
         if not os.path.exists(gitname):
             print("Error: no source directory for project '%s' found (expected at '%s')" % (proj, os.path.abspath(gitname)))
             return 1
@@ -144,12 +1311,70 @@ def main():
         for p in generated:
             if not os.path.exists(p):
                 os.mkdir(p)
-        
-        repo = RepoPrep(proj, gitname, buildname, prefix, addconfigureenvs)
-        res = repo.prepare()
-        if res != 0: # some error occurred (already reported by the class)
-            return res
-    return 0
+
+        logfile = os.path.abspath(os.path.join(STATEDIR, "%s.log" % proj))
+        if os.path.exists(logfile):
+            os.remove(logfile)
+
+        # running in parallel mixes up the console output so mark each line with the project then
+        outputprefix = ""
+        if jobs > 1:
+            outputprefix = "%s| " % proj
+
+        repos.append(RepoPrep(proj, gitname, buildname, prefix, settings[proj]["addconfigureenvs"], logfile,
+                              sharedcache = sharedcache,
+                              outputprefix = outputprefix,
+                              jobserver = jobserver,
+                              force = proj in forced,
+                              options = settings[proj]["options"],
+                              journal = journal,
+                              compilercache = compilercache,
+                              tmpfs = tmpfs if proj in syncpaths else None,
+                              syncpath = syncpaths.get(proj)))
+
+    starttime = time.time()
+    res = run_projects(repos, depends, jobs, loadaverage)
+    write_summary(os.path.join(STATEDIR, "summary.json"), repos, res, time.time() - starttime)
+    if tracefile:
+        tracer.summary()
+        tracer.write(tracefile)
+        print("Info: trace written to %s" % tracefile)
+    return res
+
+
+def write_summary(fname, repos, result, walltime):
+    '''
+        write the timing of all projects and phases of this run as JSON
+    '''
+    summary = { "result"   : result,
+                "wall"     : walltime,
+                "cpu"      : 0.0,
+                "projects" : [] }
+    for repo in repos:
+        if not repo.phases:
+            continue # never started
+        entry = { "name"   : repo.projectname,
+                  "wall"   : sum(p.get("wall", 0.0) for p in repo.phases),
+                  "cpu"    : sum(p.get("cpu", 0.0) for p in repo.phases),
+                  "phases" : repo.phases }
+        if repo.compilercache:
+            entry["ccache"] = repo.compilercache.stats(repo.projectname)
+            cached = entry["ccache"]["hits"] + entry["ccache"]["misses"]
+            print("Info: ccache for %s: %d hits, %d misses (%d%% hit rate), %d uncacheable" % (repo.projectname,
+                entry["ccache"]["hits"], entry["ccache"]["misses"], entry["ccache"]["hits"] * 100 / (cached or 1),
+                entry["ccache"]["uncacheable"]))
+        summary["cpu"] += entry["cpu"]
+        summary["projects"].append(entry)
+    write_stamp(fname, summary)
+    print("Info: finished after %.1fs (%.1fs cpu), timing summary written to %s" % (walltime, summary["cpu"], fname))
+
+
+def find_executable(name):
+    for path in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
 
 
 def get_options(project):
@@ -169,8 +1394,19 @@ def get_options(project):
             print("Error: opening configure options file '%s' : '%s'" % (fname, str(exc)))
     return ' '.join(result)
 
-try:
-    main()
-except KeyboardInterrupt:
-    pass
+
+def split_options(options):
+    '''
+        the arguments of a configure options string as the shell would split them
+    '''
+    try:
+        return shlex.split(options)
+    except ValueError:
+        return options.split() # unbalanced quotes, configure will complain itself
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
 
@@ -37,27 +37,504 @@ from getopt import gnu_getopt, GetoptError
 import re
 import shutil
 import subprocess
+import threading
+import time
+import fcntl
+import multiprocessing
+import cPickle
+import json
+import errno
+import filecmp
+import socket
+import signal
+import traceback
+from collections import OrderedDict
+from collections import deque
 
-def pexec(args, showoutput = False):
-    buf = None
-    res = ""
-    p = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-    while buf != "":
-        buf = p.stdout.read()
+from phasetrace import tracer, command_name
+
+# if set, the complete output of all commands run by pexec is appended to this file
+LOGFILE = None
+# default for the number of seconds after which commands run by pexec are killed
+TIMEOUT = None
+# if set, the spans of all commands and file operations are written to this file as Chrome trace events
+TRACEFILE = None
+# keeps the lines of commands running at the same time from getting mixed up
+_outputlock = threading.Lock()
+# seconds between the checks of a daemon for changes in its tree
+DAEMONREFRESH = 10
+# ioctl sharing the data of one file with another on btrfs, xfs etc. (_IOW(0x94, 9, int) in linux/fs.h)
+FICLONE = 0x40049409
+
+def pexec(args, showoutput = False, timeout = None, taillines = 200, cwd = None, env = None, prefix = "", logfile = None):
+    '''
+        run a command and pass its output on line by line as it arrives (if showoutput
+        is set, each line starting with prefix). only the last taillines lines are kept and
+        returned for reporting errors, the complete output goes to logfile (or LOGFILE) if
+        that is set. the command is killed if it takes longer than timeout (or TIMEOUT) seconds.
+    '''
+    with tracer.span(command_name(args), "command", command = ' '.join(args), cwd = cwd):
+        return _pexec(args, showoutput, timeout, taillines, cwd, env, prefix, logfile)
+
+
+def _pexec(args, showoutput, timeout, taillines, cwd, env, prefix, logfile):
+    if timeout is None:
+        timeout = TIMEOUT
+    if logfile is None:
+        logfile = LOGFILE
+    tail = deque(maxlen = taillines)
+    starttime = time.time()
+    logfh = None
+    if logfile:
+        logfh = open(logfile, "a")
+        logfh.write("+ %s%s\n" % ("(in %s) " % cwd if cwd else "", ' '.join(args)))
+    try:
+        # with a timeout the command gets a process group of its own so everything it
+        # started can be killed (killing only e.g. fakeroot leaves its children running
+        # and holding the pipe open)
+        p = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, bufsize = -1, cwd = cwd, env = env,
+                             preexec_fn = os.setsid if timeout else None)
+        killed = []
+        def kill():
+            killed.append(True)
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass # already gone
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        try:
+            for line in iter(p.stdout.readline, ""):
+                if showoutput:
+                    with _outputlock:
+                        sys.stdout.write(prefix + line)
+                        sys.stdout.flush()
+                if logfh:
+                    logfh.write(line)
+                tail.append(line)
+            p.wait()
+        except KeyboardInterrupt:
+            # not in our process group so it did not get the Ctrl-C
+            if timeout:
+                kill()
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+        elapsed = time.time() - starttime
+        if killed:
+            print("Error: '%s' killed after %ds" % (' '.join(args), timeout))
         if showoutput:
-            sys.stdout.write(buf)
-            sys.stdout.flush()
-        res += buf
-    p.wait()
-    buf = p.stdout.read()
-    if showoutput:
-        sys.stdout.write(buf)
-        sys.stdout.flush()
-    res += buf
-    return res.strip(), p.returncode
+            print("%s('%s' finished after %.1fs)" % (prefix, ' '.join(args), elapsed))
+        if logfh:
+            logfh.write("+ status %d after %.1fs\n" % (p.returncode, elapsed))
+    finally:
+        if logfh:
+            logfh.close()
+    return ''.join(tail).strip(), p.returncode
+
+
+_pexeccache = {}
+
+def cached_pexec(args):
+    '''
+        pexec for commands whose output does not change while we run (lsb_release, uname),
+        a daemon only runs them once
+    '''
+    key = tuple(args)
+    if key not in _pexeccache:
+        output, err = pexec(args)
+        if err:
+            return output, err
+        _pexeccache[key] = (output, err)
+    return _pexeccache[key]
+
+
+class WorktreePool:
+    '''
+        git worktrees of the kernel tree (in .git/ukh-worktrees) to run the clean and
+        updateconfigs steps in, so the main tree does not need to be reset afterwards.
+        a worktree is cleaned when it is given back so the next user finds it ready
+        and again when it is taken (a killed user never gives it back), a lock file
+        per worktree keeps several users from taking the same one.
+    '''
+    def __init__(self):
+        self.pooldir = None
+        self.locks = {}
+        gitdir, err = pexec(['git', 'rev-parse', '--git-common-dir'])
+        if err:
+            print("Error: cannot find the git directory (needs git 2.5 or later for worktrees):\n'%s'" % gitdir)
+            return
+        self.pooldir = os.path.join(os.path.abspath(gitdir), "ukh-worktrees")
+
+    @tracer.traced("acquire worktree", "file")
+    def acquire(self):
+        '''
+            returns the path of a clean worktree checked out at the HEAD of the
+            main tree, or None on errors
+        '''
+        if not self.pooldir:
+            return None
+        if not os.path.exists(self.pooldir):
+            os.makedirs(self.pooldir)
+        head, err = pexec(['git', 'rev-parse', 'HEAD'])
+        if err:
+            print("Error getting HEAD of the kernel tree:\n'%s'" % head)
+            return None
+
+        idx = 0
+        while True:
+            path = os.path.join(self.pooldir, "wt%d" % idx)
+            lockh = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lockh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                lockh.close() # in use
+                idx += 1
+
+        if not os.path.exists(path):
+            print("creating worktree '%s'" % path)
+            output, err = pexec(['git', 'worktree', 'add', '--detach', path, head])
+        else:
+            # only touches what differs from the last checkout, -f and clean throw
+            # away what a user that did not get to release() left behind
+            output, err = pexec(['git', 'checkout', '-f', '-q', '--detach', head], cwd = path)
+            if not err:
+                output, err = pexec(['git', 'clean', '-dfq'], cwd = path)
+        if err:
+            print("Error preparing worktree '%s':\n'%s'" % (path, output))
+            lockh.close()
+            return None
+        self.locks[path] = lockh
+        return path
+
+    @tracer.traced("release worktree", "file")
+    def release(self, path):
+        '''
+            clean the worktree for the next user and give it back
+        '''
+        try:
+            for cmd in ( ['git', 'reset', '-q', '--hard'], ['git', 'clean', '-dfq'] ):
+                output, err = pexec(cmd, cwd = path)
+                if err:
+                    print("Warning: cleaning worktree '%s' failed:\n'%s'" % (path, output))
+                    break
+        finally:
+            self.locks.pop(path).close()
+
+
+CONFIGLINE = re.compile(r'''^(CONFIG_\w+)=(.*)$''')
+UNSETLINE  = re.compile(r'''^# (CONFIG_\w+) is not set$''')
+
+def parse_config(text):
+    '''
+        parse a kernel config (or a fragment of one) into an OrderedDict of
+        symbol -> value, "# CONFIG_X is not set" becomes the value "n"
+    '''
+    values = OrderedDict()
+    for l in text.splitlines():
+        m = CONFIGLINE.match(l) or UNSETLINE.match(l)
+        if m:
+            values[m.group(1)] = m.group(2) if m.lastindex == 2 else "n"
+    return values
+
+
+def format_config(values):
+    lines = []
+    for symbol, value in values.items():
+        if value == "n":
+            lines.append("# %s is not set\n" % symbol)
+        else:
+            lines.append("%s=%s\n" % (symbol, value))
+    return ''.join(lines)
+
+
+def merge_configs(*configs):
+    '''
+        a new config with the values of all given ones, later ones win
+        (e.g. the common configs and a flavour config stacked into the full config)
+    '''
+    result = OrderedDict()
+    for values in configs:
+        result.update(values)
+    return result
+
+
+def diff_configs(configs):
+    '''
+        compare several configs, returns (symbol, [ value or None per config ]) for
+        all symbols that are not the same in all of them
+    '''
+    symbols = OrderedDict()
+    for values in configs:
+        for symbol in values:
+            symbols[symbol] = True
+    result = []
+    for symbol in symbols:
+        row = [ values.get(symbol) for values in configs ]
+        if row.count(row[0]) != len(row):
+            result.append((symbol, row))
+    return result
+
+
+class KernelConfigCache:
+    '''
+        parsed kernel configs by path, reused as long as mtime and size of the file
+        stay the same. kept in .git/ukh-cache so later runs can use them as well
+        (save() at the end of a run writes what was parsed).
+        the returned configs are shared, do not modify them.
+    '''
+    def __init__(self):
+        self.fname = None
+        self.entries = {}
+        self.dirty = False
+
+    @tracer.traced("load kernel config cache", "file")
+    def load(self):
+        fname = os.path.join(os.getcwd(), ".git", "ukh-cache", "kconfig.pickle")
+        if self.fname == fname:
+            return
+        self.save()
+        self.fname = fname
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(fname, "rb") as fh:
+                self.entries = cPickle.load(fh)
+        except Exception:
+            pass # no usable cache yet
+
+    def save(self):
+        '''
+            write the cache if configs were parsed since it was last written
+        '''
+        if self.dirty:
+            self.write()
+            self.dirty = False
+
+    @tracer.traced("save kernel config cache", "file")
+    def write(self):
+        cachedir = os.path.dirname(self.fname)
+        if not os.path.isdir(os.path.dirname(cachedir)):
+            return # not in a git tree, keep it in memory only
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        tmpname = "%s.%d" % (self.fname, os.getpid())
+        with open(tmpname, "wb") as fh:
+            cPickle.dump(self.entries, fh, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, self.fname)
+
+    def get(self, path):
+        self.load()
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            return entry[2]
+        with tracer.span("parse kernel config", "file", path = path):
+            with open(path, "rt") as fh:
+                values = parse_config(fh.read())
+        self.entries[path] = (st.st_mtime, st.st_size, values)
+        self.dirty = True
+        return values
+
+kernelconfigs = KernelConfigCache()
+
+
+def full_config(debiandir, arch, flavourname, treedir = None):
+    '''
+        the complete config of a flavour as the build puts it together from
+        config.common.ubuntu, config.common.<arch> and config.flavour.<flavour>
+        of the tree in treedir (default the current dir)
+    '''
+    mcfgdir = os.path.join(treedir or os.getcwd(), debiandir, "config")
+    layers = []
+    for path in ( os.path.join(mcfgdir, "config.common.ubuntu"),
+                  os.path.join(mcfgdir, arch, "config.common.%s" % arch),
+                  os.path.join(mcfgdir, arch, "config.flavour.%s" % flavourname) ):
+        if os.path.exists(path):
+            layers.append(kernelconfigs.get(path))
+    return merge_configs(*layers)
+
+
+def show_config_diff(flavourname, arch, debiandir):
+    '''
+        print the differences between the running kernel config, the generic config
+        and the config of the flavour
+    '''
+    currentkernel, err = cached_pexec(['uname', '-r'])
+    names = []
+    configs = []
+    currentconfig = "/boot/config-%s" % currentkernel
+    if not err and os.path.exists(currentconfig):
+        names.append("running")
+        configs.append(kernelconfigs.get(currentconfig))
+    for name in ( "generic", flavourname ):
+        if os.path.exists(os.path.join(os.getcwd(), debiandir, "config", arch, "config.flavour.%s" % name)):
+            names.append(name)
+            configs.append(full_config(debiandir, arch, name))
+    if len(configs) < 2:
+        print("Error: need at least two of the running, generic and %s configs to compare" % flavourname)
+        return False
+
+    rows = diff_configs(configs)
+    width = max([ len(symbol) for symbol, row in rows ] + [ 6 ])
+    print(("%-*s" % (width, "symbol")) + ''.join(" %-12s" % name for name in names))
+    for symbol, row in rows:
+        print(("%-*s" % (width, symbol)) + ''.join(" %-12s" % (value if value is not None else "-") for value in row))
+    print("%d differences for %s" % (len(rows), arch))
+    return True
+
+
+def version_key(version):
+    '''
+        sort key for versions like 3.13.0-10 so they sort by their numbers
+        (3.13.0-9 before 3.13.0-10, which a plain string sort gets wrong)
+    '''
+    return [ int(part) if part.isdigit() else part for part in re.findall(r'''\d+|[^\d.\-~+]+''', version) ]
+
+
+def git_head(topdir):
+    '''
+        commit id of HEAD read from the git files directly (saves running git),
+        None if it cannot be found that way
+    '''
+    gitdir = os.path.join(topdir, ".git")
+    try:
+        with open(os.path.join(gitdir, "HEAD"), "rt") as fh:
+            head = fh.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        if os.path.exists(os.path.join(gitdir, ref)):
+            with open(os.path.join(gitdir, ref), "rt") as fh:
+                return fh.read().strip()
+        with open(os.path.join(gitdir, "packed-refs"), "rt") as fh:
+            for l in fh:
+                if l.strip().endswith(" " + ref):
+                    return l.split()[0]
+    except IOError:
+        pass
+    return None
+
+
+class TreeIndex:
+    '''
+        what the debian directories of the kernel tree contain: the debian branch
+        directory, the configs (arches) with their flavours, the abi versions (sorted
+        by version), the control vars files and the rules files. kept in
+        .git/ukh-cache/index.json and only scanned again when git HEAD or the
+        mtime of one of the scanned directories changed.
+    '''
+    def __init__(self):
+        self.index = None
+
+    def fname(self):
+        return os.path.join(os.getcwd(), ".git", "ukh-cache", "index.json")
+
+    def valid(self, index):
+        if index.get("topdir") != os.getcwd() or index.get("head") != git_head(os.getcwd()):
+            return False
+        for path, mtime in index["mtimes"].items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def get(self, refresh = False):
+        '''
+            returns the index, None on errors (which are reported)
+        '''
+        if not refresh and self.index and self.valid(self.index):
+            return self.index
+        if not refresh:
+            try:
+                with open(self.fname(), "rt") as fh:
+                    index = json.load(fh)
+                if self.valid(index):
+                    self.index = index
+                    return index
+            except (IOError, ValueError, KeyError):
+                pass # no usable index yet
+        self.index = self.scan()
+        if self.index and os.path.isdir(os.path.join(os.getcwd(), ".git")):
+            cachedir = os.path.dirname(self.fname())
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            tmpname = "%s.%d" % (self.fname(), os.getpid())
+            with open(tmpname, "wt") as fh:
+                json.dump(self.index, fh, indent = 1, sort_keys = True)
+            os.rename(tmpname, self.fname())
+        return self.index
+
+    @tracer.traced("scan debian tree", "file")
+    def scan(self):
+        topdir = os.getcwd()
+        envfile = os.path.join(topdir, "debian", "debian.env")
+        index = { "topdir" : topdir, "head" : git_head(topdir), "mtimes" : {} }
+
+        # this depends on what is set up in debian.env
+        debiandir = None
+        try:
+            with open(envfile, 'rt') as envfh:
+                for l in envfh.readlines():
+                    m = re.match("DEBIAN\s*=\s*(.+)", l)
+                    if m:
+                        debiandir, = m.groups()
+                        break
+        except Exception, exc:
+            print("Error opening debian environment setup:\n'%s'" % str(exc))
+            return None
+        if debiandir == None:
+            print("Error getting debian branch directory from debian/debian.env")
+            return None
+        index["debiandir"] = debiandir
+        index["mtimes"][envfile] = os.stat(envfile).st_mtime
+
+        def listdir(path):
+            if not os.path.isdir(path):
+                return []
+            index["mtimes"][path] = os.stat(path).st_mtime
+            return sorted(os.listdir(path))
+
+        mcfgdir = os.path.join(topdir, debiandir, "config")
+        index["arches"] = {}
+        for arch in listdir(mcfgdir):
+            if os.path.isdir(os.path.join(mcfgdir, arch)):
+                index["arches"][arch] = [ f[len("config.flavour."):] for f in listdir(os.path.join(mcfgdir, arch))
+                                          if f.startswith("config.flavour.") ]
+        abidir = os.path.join(topdir, debiandir, "abi")
+        index["abis"] = sorted([ e for e in listdir(abidir) if os.path.isdir(os.path.join(abidir, e)) ], key = version_key)
+        index["vars"] = [ f[len("vars."):] for f in listdir(os.path.join(topdir, debiandir, "control.d")) if f.startswith("vars.") ]
+        index["rules"] = [ f[:-3] for f in listdir(os.path.join(topdir, debiandir, "rules.d")) if f.endswith(".mk") ]
+        return index
+
+treeindex = TreeIndex()
+
+
+def print_index(index):
+    print("debian directory: %s" % index["debiandir"])
+    print("configs (flavours):")
+    for arch in sorted(index["arches"]):
+        print("  %-10s %s" % (arch, ' '.join(index["arches"][arch])))
+    print("abi versions: %s" % ' '.join(index["abis"]))
+    print("control vars: %s" % ' '.join(index["vars"]))
+    print("rules: %s" % ' '.join(index["rules"]))
 
 
 def check_local(localname, debiandir):
+    return add_local(ask_local(localname), debiandir)
+
+
+def ask_local(localname):
+    '''
+        returns the name for the local version, None if none is wanted
+    '''
     # if a localname is set we assume that we do want a local version
     if localname == None:
         sys.stdout.write("Do you want to make this a local .DEB so the version is higher than the distribution one ")
@@ -69,8 +546,15 @@ def check_local(localname, debiandir):
             sys.stdout.write("Enter a name you want to use for the local version (will get appended to the official version)\n")
             sys.stdout.flush()
             localname = sys.stdin.readline().strip()
-        else:
-            return True # no local version requested
+    return localname
+
+
+def add_local(localname, debiandir):
+    '''
+        add the local version to the changelog (if there is one), returns True on success
+    '''
+    if not localname:
+        return True # no local version requested
     
     msg = "Local version of the Ubuntu Kernel Package"
     changelogpath = os.path.join(debiandir, "changelog")
@@ -88,13 +572,14 @@ def check_local(localname, debiandir):
     return True
 
 
-def get_arch(debiandir):
-    mcfgdir = os.path.join(os.getcwd(), debiandir, "config")
-    configs = []
-    for x in os.listdir(mcfgdir):
-        if os.path.isdir(os.path.join(mcfgdir,x)):
-            configs.append(x)
-    configs = sorted(configs)
+def get_arch(index, arch = None):
+    configs = sorted(index["arches"])
+
+    if arch:
+        if arch not in configs:
+            print("Error: unknown config '%s', available are: %s" % (arch, ', '.join(configs)))
+            return None
+        return arch
     
     print("Choose config:")
     for idx, cfg in enumerate(configs):
@@ -111,23 +596,41 @@ def get_arch(debiandir):
     return arch
 
 
-def generate_flavour(flavourname, arch, debiandir):
-    currentkernel, err = pexec(['uname', '-r'])
+@tracer.traced("generate flavour", "phase")
+def generate_flavour(flavourname, arch, debiandir, worktree = None, srcconfig = None, showoutput = True, overlay = None):
+    '''
+        create the config of the new flavour and run it through updateconfigs, in the
+        given worktree if there is one (else in the current tree which then needs to
+        be reset afterwards). the config to start from is asked for unless srcconfig
+        is given ("generic", "running" or a path), the values of overlay (a parsed
+        config) are set in it before updateconfigs. returns the resulting config.
+    '''
+    currentkernel, err = cached_pexec(['uname', '-r'])
     if err:
         print("Error reading current kernel with 'uname -r' : '%s'" % currentkernel)
         return None
 
     mcfgdir = os.path.join(os.getcwd(), debiandir, "config")
+    treedir = worktree or os.getcwd()
 
     # sanity check
-    srcconfig = os.path.join(mcfgdir, arch, "config.flavour.generic")
+    genericconfig = os.path.join(mcfgdir, arch, "config.flavour.generic")
+    if not os.path.exists(genericconfig):
+        print("Error, expected generic kernel config at '%s' but it does not exist" % genericconfig)
+        return None
+
+    currentconfig = "/boot/config-%s" % (currentkernel)
+    asksrc = srcconfig is None
+    if srcconfig is None or srcconfig == "generic":
+        srcconfig = genericconfig
+    elif srcconfig == "running":
+        srcconfig = currentconfig
     if not os.path.exists(srcconfig):
-        print("Error, expected generic kernel config at '%s' but it does not exist" % srcconfig)
+        print("Error, kernel config '%s' does not exist" % srcconfig)
         return None
 
     # offer choice of using the currently running config (may fail if kernel versions are too distant)
-    currentconfig = "/boot/config-%s" % (currentkernel)
-    if os.path.exists(currentconfig):
+    if asksrc and os.path.exists(currentconfig):
         sys.stdout.write('Do you want to use the kernel config of the currently running kernel "%s" (y/N)? ' % currentkernel)
         sys.stdout.flush()
         answer = sys.stdin.readline().strip().lower()
@@ -135,26 +638,31 @@ def generate_flavour(flavourname, arch, debiandir):
             srcconfig = currentconfig
                 
     
-    destconfig = os.path.join(mcfgdir, arch, "config.flavour.%s" % flavourname)
+    destconfig = os.path.join(treedir, debiandir, "config", arch, "config.flavour.%s" % flavourname)
     print("using '%s' kernel config to create new flavour %s" % (srcconfig, flavourname))
     
-    shutil.copy2(srcconfig, destconfig)
+    if overlay:
+        print("applying %d overlay settings" % len(overlay))
+        with open(destconfig, "wt") as configh:
+            configh.write(format_config(merge_configs(kernelconfigs.get(srcconfig), overlay)))
+    else:
+        clone_file(srcconfig, destconfig)
     
     print("cleaning kernel dir")
-    output, err = pexec(['fakeroot', 'debian/rules', 'clean'], True)
+    output, err = pexec(['fakeroot', 'debian/rules', 'clean'], showoutput, cwd = treedir)
     if err:
-        print("Error cleaning config")
+        print("Error cleaning config:\n%s" % output)
         return None
 
     print("updating configs")
-    output, err = pexec(['fakeroot', 'debian/rules', 'updateconfigs'], True)
+    output, err = pexec(['fakeroot', 'debian/rules', 'updateconfigs'], showoutput, cwd = treedir)
     if err:
-        print("Error updating configs")
+        print("Error updating configs:\n%s" % output)
         return None
 
-    # here we'd usually want to edit the config which is a bit tricky
-    # to do from a script, probably better to split this here somehow
-    # so hand back the updated config file for further processing
+    # changes we want are best given as overlay, editing the config here
+    # would need another updateconfigs round, so hand back the updated
+    # config file for further processing
     try:
         with open(destconfig, "rt") as configh:
             cfg = configh.read()
@@ -162,73 +670,264 @@ def generate_flavour(flavourname, arch, debiandir):
         print("Error reading the generated config file '%s': '%s'" % (destconfig, str(e)))
         return None
 
+    if overlay:
+        # updateconfigs changes what conflicts with the dependencies of other options,
+        # what it moved into the common configs is still set for the flavour
+        result = full_config(debiandir, arch, flavourname, treedir)
+        for symbol, row in diff_configs([ overlay, result ]):
+            if row[0] is not None:
+                print("Warning: overlay sets %s=%s but updateconfigs changed it to %s" % (symbol, row[0], row[1] or "nothing"))
+
     return cfg
 
 
-def patch_flavour(flavourname, savedconfig, arch, debiandir, localname):
-    # we need to reset the dir so build works
-    # this means we have to save the generated config
+def patch_flavour(flavourname, savedconfig, arch, debiandir, localname, resettree = True, dryrun = False):
+    '''
+        returns True if the flavour was registered (or would have been for a dry run)
+    '''
+    if dryrun:
+        print("changes that would be made to register %s for %s:" % (flavourname, arch))
+        plan = PatchPlan()
+        return register_flavour(plan, flavourname, savedconfig, arch, debiandir) and plan.apply(True)
 
-    sys.stdout.write("Need to clear out the build dir, this will delete everything not committed!!!\n")
-    sys.stdout.write("Are you sure (y/N)?")
-    sys.stdout.flush()
-    answer = sys.stdin.readline().strip().lower()
-    if answer != 'y':
-        print("build cancelled.")
-        return
-    
-    output, err = pexec(['git', 'reset', '--hard'], True)
-    if err:
-        print("Error git-resetting")
-        return
-    
-    output, err = pexec(['git', 'clean', '-df'], True)
-    if err:
-        print("Error git-cleaning")
-        return
+    # unless the config was generated in a worktree we need to reset the dir so
+    # build works, this means we have to save the generated config
+    if resettree:
+        sys.stdout.write("Need to clear out the build dir, this will delete everything not committed!!!\n")
+        sys.stdout.write("Are you sure (y/N)?")
+        sys.stdout.flush()
+        answer = sys.stdin.readline().strip().lower()
+        if answer != 'y':
+            print("build cancelled.")
+            return False
+
+        output, err = pexec(['git', 'reset', '--hard'], True)
+        if err:
+            print("Error git-resetting")
+            return False
+
+        output, err = pexec(['git', 'clean', '-df'], True)
+        if err:
+            print("Error git-cleaning")
+            return False
     
     if not check_local(localname, debiandir):
-        return
+        return False
 
-    print("copying back kernel config")
-    mcfgdir = os.path.join(os.getcwd(), debiandir, "config")
-    kernelconfig = os.path.join(mcfgdir, arch, "config.flavour.%s" % flavourname)
+    print("registering %s for %s" % (flavourname, arch))
+    plan = PatchPlan()
+    if not register_flavour(plan, flavourname, savedconfig, arch, debiandir) or not plan.apply():
+        return False
+
+    print("final kernel dir clean to generate the correct debian files")
+    output, err = pexec(['fakeroot', 'debian/rules', 'clean'], True)
+    if err:
+        print("Error cleaning config")
+        return False
+    return True
+
+
+def clone_file(srcpath, destpath, readonly = False):
+    '''
+        make destpath a copy of srcpath without duplicating the data where possible: as
+        a reflink if the filesystem can do that, else as a hard link if the file is only
+        read afterwards (readonly, the abi lists), else as a plain copy. an existing
+        destpath is replaced. returns how it was done ("reflink", "hardlink" or "copy").
+        note that hard links only stay correct because files are never changed in place
+        here but replaced by renames, which breaks the link on the first write.
+    '''
+    if os.path.lexists(destpath):
+        os.remove(destpath)
     try:
-        with open(kernelconfig,'wt+') as configh:
-            configh.write(savedconfig)
-    except Exception, e:
-        print("Error writing back kernel config to '%s' : '%s'" % (kernelconfig, str(e)))
-        return
-    
-    print("getting last abi")
+        with open(srcpath, "rb") as src:
+            with open(destpath, "wb") as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        shutil.copystat(srcpath, destpath)
+        return "reflink"
+    except (IOError, OSError), e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+            raise
+        os.remove(destpath)
+    if readonly:
+        try:
+            os.link(srcpath, destpath)
+            return "hardlink"
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    shutil.copy2(srcpath, destpath)
+    return "copy"
+
+
+class PatchPlan:
+    '''
+        changes to files of the tree collected first and applied together: every file is
+        read and written once however many edits it gets, edits that are already there are
+        left out (so registering a flavour twice changes nothing). the new files are staged
+        next to the old ones first (copies through clone_file()) and then all put in place
+        by renames. if that fails for one of them the ones already replaced are put back.
+    '''
+    def __init__(self):
+        self.files = OrderedDict() # path -> [ (kind, arg) ]
+
+    def write(self, path, content):
+        self.files.setdefault(path, []).append(("write", content))
+
+    def copy(self, srcpath, path, readonly = False):
+        '''
+            make path a copy of srcpath, readonly if the copy is not changed
+            afterwards (see clone_file())
+        '''
+        self.files.setdefault(path, []).append(("copy", (srcpath, readonly)))
+
+    def append_word(self, path, pattern, word):
+        '''
+            append word to the lines matching pattern unless they already have it
+        '''
+        self.files.setdefault(path, []).append(("append", (pattern, word)))
+
+    def changes(self):
+        '''
+            returns [ (path, new content or (file to copy, readonly), descriptions) ]
+            for the files that really change
+        '''
+        result = []
+        for path, edits in self.files.items():
+            if [ kind for kind, arg in edits ] == [ "copy" ]:
+                # plain copies are staged by clone_file() without reading them
+                srcpath, readonly = edits[0][1]
+                if not os.path.exists(path) or not filecmp.cmp(srcpath, path, False):
+                    result.append((path, edits[0][1], [ "copy of %s" % os.path.basename(srcpath) ]))
+                continue
+            content = None
+            if os.path.exists(path):
+                with open(path, "rb") as fh:
+                    content = fh.read()
+            newcontent = content
+            descriptions = []
+            for kind, arg in edits:
+                if kind == "write":
+                    newcontent = arg
+                    descriptions.append("write")
+                elif kind == "copy":
+                    with open(arg[0], "rb") as fh:
+                        newcontent = fh.read()
+                    descriptions.append("copy of %s" % os.path.basename(arg[0]))
+                elif kind == "append":
+                    pattern, word = arg
+                    if newcontent is None:
+                        raise IOError("'%s' does not exist" % path)
+                    lines = []
+                    for l in newcontent.splitlines(True):
+                        if re.match(pattern, l.strip()) and word not in l.split():
+                            l = l.strip() + " %s\n" % word
+                        lines.append(l)
+                    newcontent = ''.join(lines)
+                    descriptions.append("add %s" % word)
+            if newcontent != content:
+                result.append((path, newcontent, sorted(set(descriptions), key = descriptions.index)))
+        return result
+
+    @tracer.traced("apply patch plan", "file")
+    def apply(self, dryrun = False):
+        '''
+            returns True if all went well (or there was nothing to do)
+        '''
+        try:
+            changes = self.changes()
+        except (IOError, OSError), e:
+            print("Error preparing the changes: '%s'" % str(e))
+            return False
+        if not changes:
+            print("nothing to change, the flavours are already registered")
+            return True
+        for path, content, descriptions in changes:
+            print("%s %s (%s)" % ("would change" if dryrun else "changing", os.path.relpath(path), ', '.join(descriptions)))
+        if dryrun:
+            return True
+
+        staged = []
+        try:
+            for path, content, descriptions in changes:
+                tmpname = path + ".ukh-new"
+                if isinstance(content, tuple):
+                    clone_file(content[0], tmpname, content[1])
+                else:
+                    with open(tmpname, "wb") as fh:
+                        fh.write(content)
+                    if os.path.exists(path):
+                        shutil.copymode(path, tmpname)
+                staged.append(tmpname)
+        except (IOError, OSError), e:
+            print("Error staging the new '%s' : '%s', nothing was changed" % (path, str(e)))
+            if os.path.isfile(path + ".ukh-new") and path + ".ukh-new" not in staged:
+                os.remove(path + ".ukh-new")
+            for tmpname in staged:
+                os.remove(tmpname)
+            return False
+
+        done = [] # (path, backup of the old file or None)
+        try:
+            for path, content, descriptions in changes:
+                backup = None
+                if os.path.exists(path):
+                    backup = path + ".ukh-old"
+                    if os.path.exists(backup):
+                        os.remove(backup)
+                    os.link(path, backup)
+                os.rename(path + ".ukh-new", path)
+                done.append((path, backup))
+        except (IOError, OSError), e:
+            print("Error changing '%s' : '%s', undoing the changes" % (path, str(e)))
+            for tmpname in staged[len(done):]:
+                if os.path.isfile(tmpname):
+                    os.remove(tmpname)
+            for path, backup in reversed(done):
+                if backup:
+                    os.rename(backup, path)
+                else:
+                    os.remove(path)
+            return False
+        for path, backup in done:
+            if backup:
+                os.remove(backup)
+        return True
+
+
+def register_flavour(plan, flavourname, savedconfig, arch, debiandir):
+    '''
+        add what is needed to write back the generated config and to make the build
+        system aware of the new flavour (abi files, getabis, rules and control vars)
+        to the plan, returns True on success
+    '''
+    mcfgdir = os.path.join(os.getcwd(), debiandir, "config")
+    plan.write(os.path.join(mcfgdir, arch, "config.flavour.%s" % flavourname), savedconfig)
+
     abidir = os.path.join(os.getcwd(), debiandir, "abi")
-    abientries = os.listdir(abidir)
-    abis = []
-    for e in abientries:
-        if os.path.isdir(os.path.join(abidir, e)):
-            abis.append(e)
-    if len(abis) == 0:
+    index = treeindex.get()
+    if not index:
+        return False
+    if len(index["abis"]) == 0:
         print("Error: empty abi directory '%s'" % abidir)
-        return
-    currentabi = sorted(abis)[-1]
+        return False
+    currentabi = index["abis"][-1]
 
     currentabidir = os.path.join(abidir, currentabi, arch)
     
-    print("copying generic abi configs to our flavour")
-    
     genericabi    = os.path.join(currentabidir, "generic")
     genericmodabi = os.path.join(currentabidir, "generic.modules")
     
     if not os.path.exists(genericabi):
         print("Error: generic abi file '%s' does not exist" % genericabi)
-        return
+        return False
 
     if not os.path.exists(genericmodabi):
         print("Error: generic abi modules file '%s' does not exist" % genericmodabi)
-        return
+        return False
     
-    shutil.copy2(genericabi,    os.path.join(currentabidir, flavourname))
-    shutil.copy2(genericmodabi, os.path.join(currentabidir, "%s.modules" % flavourname))
+    # the abi lists are only read, they can share their data with the generic ones
+    plan.copy(genericabi,    os.path.join(currentabidir, flavourname), True)
+    plan.copy(genericmodabi, os.path.join(currentabidir, "%s.modules" % flavourname), True)
     
     # we need to make the build system aware or our flavours
     getabifile = os.path.join(os.getcwd(), debiandir, "etc", "getabis")
@@ -236,52 +935,441 @@ def patch_flavour(flavourname, savedconfig, arch, debiandir, localname):
     varssrcfile = os.path.join(os.getcwd(), debiandir, "control.d", "vars.generic")
 
     for filename, searchpattern in ( (getabifile, r'''getall\s+%s''' % arch), (rulesfile, r'''flavours.*''') ):
-        try:
-            print("appending flavour to %s" % filename)
-            with open(filename, 'rt') as fh:
-                linebuf = fh.readlines()
-                
-                with open(filename + '.repl', 'wb') as wh:
-                    for l in linebuf:
-                        if(re.match(searchpattern, l.strip())):
-                            wh.write(l.strip() + " %s\n" % flavourname)
-                        else:
-                            wh.write(l)
-                
-        except Exception, e:
-            print("Error appending flavour to file '%s' : '%s'" % (filename, str(e)))
-            return
-        shutil.move(filename + '.repl', filename)
+        if not os.path.exists(filename):
+            print("Error: file '%s' does not exist" % filename)
+            return False
+        plan.append_word(filename, searchpattern, flavourname)
 
     varsdestfile = os.path.join(os.getcwd(), debiandir, "control.d", "vars.%s" % flavourname)
     if not os.path.exists(varssrcfile):
         print("Error: file '%s' does not exist" % varssrcfile)
-        return
-    shutil.copy2(varssrcfile, varsdestfile)
+        return False
+    plan.copy(varssrcfile, varsdestfile)
+    return True
+
+
+def read_batch(fname):
+    '''
+        read the flavours to generate for the batch mode, one per line as
+        "<flavour> <arch> [<source config>]", returns a list of (flavour, arch, srcconfig)
+    '''
+    entries = []
+    try:
+        with open(fname, "rt") as fh:
+            for l in fh:
+                l = l.split('#')[0].split()
+                if not l:
+                    continue
+                if len(l) not in (2, 3):
+                    print("Error: expected '<flavour> <arch> [<source config>]' in '%s' but got '%s'" % (fname, ' '.join(l)))
+                    return None
+                if len(l) == 2:
+                    l.append("generic")
+                elif l[2] not in ("generic", "running"):
+                    l[2] = os.path.abspath(l[2])
+                entries.append(tuple(l))
+    except IOError, e:
+        print("Error reading batch file '%s' : '%s'" % (fname, str(e)))
+        return None
+    return entries
+
+
+def batch_job(job):
+    '''
+        generate one flavour of a batch in a worktree of its own (runs in a pool process),
+        returns (flavour, arch, config or None, trace events recorded for it)
+    '''
+    global LOGFILE
+    flavourname, arch, srcconfig, debiandir, logfile, overlay = job
+    LOGFILE = logfile
+    tracemark = len(tracer.events)
+    if os.path.exists(logfile):
+        os.remove(logfile)
+    print("generating %s for %s (output in %s)" % (flavourname, arch, logfile))
+    pool = WorktreePool()
+    worktree = pool.acquire()
+    if not worktree:
+        return flavourname, arch, None, tracer.events_since(tracemark)
+    try:
+        config = generate_flavour(flavourname, arch, debiandir, worktree, srcconfig, False, overlay)
+    finally:
+        pool.release(worktree)
+        kernelconfigs.save()
+    print("finished %s for %s%s" % (flavourname, arch, "" if config else " with errors"))
+    return flavourname, arch, config, tracer.events_since(tracemark)
+
+
+@tracer.traced("generate batch", "phase")
+def generate_batch(entries, debiandir, jobs, overlay = None, dryrun = False, localname = None):
+    '''
+        run the clean/updateconfigs steps for all batch entries at the same time (up to
+        jobs of them) and register the resulting flavours in the current tree afterwards
+        (all in one go, together with the local version if localname is set), returns
+        True if all went well
+    '''
+    logdir = os.path.join(os.getcwd(), ".git", "ukh-logs")
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    batch = [ (flavourname, arch, srcconfig, debiandir, os.path.join(logdir, "%s-%s.log" % (flavourname, arch)), overlay)
+              for flavourname, arch, srcconfig in entries ]
+    pool = multiprocessing.Pool(min(jobs, len(batch)))
+    try:
+        # a timeout keeps the wait interruptible by Ctrl-C
+        results = pool.map_async(batch_job, batch, 1).get(365 * 24 * 3600)
+    finally:
+        pool.terminate()
+    for flavourname, arch, config, recorded in results:
+        tracer.add(recorded)
+    results = [ (flavourname, arch, config) for flavourname, arch, config, recorded in results ]
+
+    failed = [ "%s/%s" % (flavourname, arch) for flavourname, arch, config in results if not config ]
+    if failed:
+        print("Error: generating %s failed, nothing was changed in the tree" % ', '.join(failed))
+        return False
+
+    plan = PatchPlan()
+    for flavourname, arch, config in results:
+        if not register_flavour(plan, flavourname, config, arch, debiandir):
+            return False
+    if dryrun:
+        print("changes that would be made to register %s:" % ', '.join("%s/%s" % (f, a) for f, a, c in results))
+        return plan.apply(True)
+    print("registering %s" % ', '.join("%s/%s" % (f, a) for f, a, c in results))
+    changelogpath = os.path.join(debiandir, "changelog")
+    changelog = None
+    if localname and os.path.exists(changelogpath):
+        with open(changelogpath, "rb") as fh:
+            changelog = fh.read()
+    if not add_local(localname, debiandir):
+        return False
+    if not plan.apply():
+        if changelog is not None:
+            with open(changelogpath, "wb") as fh:
+                fh.write(changelog)
+        return False
 
     print("final kernel dir clean to generate the correct debian files")
     output, err = pexec(['fakeroot', 'debian/rules', 'clean'], True)
     if err:
         print("Error cleaning config")
+        return False
+    return True
+
+
+def build_target(target, env, logfile, result):
+    '''
+        run one debian/rules target (in a thread of its own), puts (status, seconds) into result
+    '''
+    if os.path.exists(logfile):
+        os.remove(logfile)
+    print("building %s (output in %s)" % (target, logfile))
+    starttime = time.time()
+    with tracer.span(target, "target"):
+        output, err = pexec(['fakeroot', 'debian/rules', target], True, env = env,
+                            prefix = "[%s] " % target, logfile = logfile)
+    result[target] = (err, time.time() - starttime)
+    if err:
+        print("Error: %s failed, the last lines of its output:\n%s" % (target, output))
+
+
+def build_flavours(flavours, jobs, useccache = False):
+    '''
+        build the packages of the flavours in the current tree: binary-indep and the flavours
+        at the same time, binary-perarch afterwards since it builds the tools in the tree
+        prepared by the first flavour. the jobs are shared out among the flavours (passed on
+        as DEB_BUILD_OPTIONS=parallel=<n>). returns True if all targets succeeded
+    '''
+    env = dict(os.environ)
+    env["skipabi"] = "true"
+    env["skipmodule"] = "true"
+    parallel = max(1, jobs // len(flavours))
+    options = [ o for o in env.get("DEB_BUILD_OPTIONS", "").split() if not o.startswith("parallel=") ]
+    env["DEB_BUILD_OPTIONS"] = ' '.join(options + [ "parallel=%d" % parallel ])
+    if useccache:
+        ccachedir = "/usr/lib/ccache"
+        if not os.path.isdir(ccachedir):
+            print("Error: ccache is not installed (%s is missing)" % ccachedir)
+            return False
+        env["PATH"] = ccachedir + os.pathsep + env.get("PATH", "")
+
+    logdir = os.path.join(os.getcwd(), ".git", "ukh-logs")
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    print("building %s with parallel=%d each%s" % (', '.join(flavours), parallel, " using ccache" if useccache else ""))
+
+    starttime = time.time()
+    result = OrderedDict()
+    for targets in ( [ "binary-indep" ] + [ "binary-%s" % f for f in flavours ], [ "binary-perarch" ] ):
+        threads = [ threading.Thread(target = build_target, name = target,
+                                     args = (target, env, os.path.join(logdir, "build-%s.log" % target), result))
+                    for target in targets ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # a timeout keeps the wait interruptible by Ctrl-C
+            while t.is_alive():
+                t.join(1)
+        if [ target for target in targets if result.get(target, (1,))[0] ]:
+            break
+    total = time.time() - starttime
+
+    print("")
+    print("build times:")
+    for target, (err, seconds) in result.items():
+        print("  %-20s %8.1fs%s" % (target, seconds, "  FAILED" if err else ""))
+    print("  %-20s %8.1fs" % ("total", total))
+    return len(result) == len(flavours) + 2 and not [ err for err, seconds in result.values() if err ]
+
+
+def daemon_socket():
+    return os.path.join(".git", "ukh-cache", "daemon.sock")
+
+
+def finish_trace():
+    if TRACEFILE:
+        tracer.summary()
+        tracer.write(TRACEFILE)
+        print("trace written to %s" % TRACEFILE)
+
+
+def forward_to_daemon(argv):
+    '''
+        run the command line in the daemon serving this tree with our input and output,
+        returns False if there is no daemon (so it has to be run here)
+    '''
+    sockname = daemon_socket()
+    if not os.path.exists(sockname):
+        return False
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(sockname)
+    except socket.error:
+        conn.close()
+        return False # left behind by a daemon that is gone
+    conn.sendall(json.dumps({ "argv" : argv, "cwd" : os.getcwd() }) + "\n")
+
+    def relay_input():
+        try:
+            for line in iter(sys.stdin.readline, ""):
+                conn.sendall(line)
+            conn.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass # the daemon is done already
+    t = threading.Thread(target = relay_input)
+    t.daemon = True
+    t.start()
+    try:
+        for data in iter(lambda: conn.recv(65536), ""):
+            sys.stdout.write(data)
+            sys.stdout.flush()
+    except socket.error, e:
+        print("Error: lost the connection to the daemon: '%s'" % str(e))
+    conn.close()
+    return True
+
+
+def warm_caches():
+    '''
+        bring the tree index and the parsed configs of all flavours up to date,
+        only what changed since the last time is read again
+    '''
+    index = treeindex.get()
+    if not index:
         return
+    for arch, flavours in index["arches"].items():
+        for flavourname in flavours:
+            full_config(index["debiandir"], arch, flavourname)
+    kernelconfigs.save()
+
+
+def serve_request(conn):
+    '''
+        run a command line forwarded by forward_to_daemon() as if it was run
+        in the client, with the input and output going through the connection
+    '''
+    global LOGFILE, TIMEOUT, TRACEFILE
+    rfile = conn.makefile("r")
+    wfile = conn.makefile("w", 1)
+    oldstdin, oldstdout = sys.stdin, sys.stdout
+    clientgone = False
+    try:
+        line = rfile.readline()
+        if not line:
+            return # just checking whether we are there
+        request = json.loads(line)
+        if request["cwd"] != os.getcwd():
+            wfile.write("Error: the daemon serves '%s', not '%s'\n" % (os.getcwd(), request["cwd"]))
+            return
+        sys.stdin, sys.stdout = rfile, wfile
+        try:
+            main(request["argv"] + [ "--no-daemon" ])
+            finish_trace()
+        except (socket.error, IOError), e:
+            # the client went away (e.g. Ctrl-C at a prompt), there is nobody to tell
+            sys.stdin, sys.stdout = oldstdin, oldstdout
+            clientgone = True
+            print("Info: client went away during the request: '%s'" % str(e))
+        except Exception:
+            sys.stdin, sys.stdout = oldstdin, oldstdout
+            traceback.print_exc(file = wfile)
+    except (ValueError, KeyError), e:
+        sys.stdin, sys.stdout = oldstdin, oldstdout
+        print("Error: bad request: '%s'" % str(e))
+    except (socket.error, IOError), e:
+        sys.stdin, sys.stdout = oldstdin, oldstdout
+        clientgone = True
+        print("Info: client went away: '%s'" % str(e))
+    finally:
+        sys.stdin, sys.stdout = oldstdin, oldstdout
+        LOGFILE = TIMEOUT = TRACEFILE = None
+        tracer.enabled = False
+        kernelconfigs.save()
+        if not clientgone:
+            try:
+                wfile.flush()
+                conn.shutdown(socket.SHUT_WR)
+                # closing with input of the client not read yet would reset the connection and
+                # lose the end of the output, the client closes its end once it got all of it
+                conn.settimeout(10)
+                while rfile.read(65536):
+                    pass
+            except socket.error:
+                pass # the client is gone
+        conn.close()
+
+
+def run_daemon():
+    '''
+        serve the command lines of clients in this tree one after another, keeping the
+        tree index, the parsed configs etc. in memory between them
+    '''
+    sockname = daemon_socket()
+    if os.path.exists(sockname):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(sockname)
+            print("Error: a daemon is already serving this tree")
+            return
+        except socket.error:
+            pass # left behind by a daemon that is gone
+        finally:
+            probe.close()
+    if not os.path.exists(os.path.dirname(sockname)):
+        os.makedirs(os.path.dirname(sockname))
+    if os.path.exists(sockname):
+        os.remove(sockname)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sockname)
+    server.listen(5)
+    server.settimeout(1.0) # keeps accept() interruptible by Ctrl-C
+    lock = threading.Lock()
+
+    def refresh():
+        while True:
+            with lock:
+                warm_caches()
+            time.sleep(DAEMONREFRESH)
+    t = threading.Thread(target = refresh)
+    t.daemon = True
+    t.start()
+
+    print("serving %s on %s" % (os.getcwd(), sockname))
+    try:
+        while True:
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            with lock:
+                try:
+                    serve_request(conn)
+                except Exception:
+                    # one failed request must not take the daemon down
+                    print("Error: serving a request failed:")
+                    traceback.print_exc()
+    finally:
+        server.close()
+        os.remove(sockname)
 
 
 def usage():
-    print("%s [options]" % os.path.basename(sys.argv[0]))
+    print("%s [options] [build|daemon]" % os.path.basename(sys.argv[0]))
+    print("    without a command the new flavour config is generated and added to the tree,")
+    print("    with 'build' the packages of the flavours (see --flavour and --batch) are built")
+    print("    with 'daemon' the tree is served on %s until interrupted: later calls in the" % daemon_socket())
+    print("    tree (apart from build) are run by the daemon which keeps what it read from the tree")
+    print("    in memory, checks it for changes every %ds and only reads changed files again" % DAEMONREFRESH)
     print("    options:")
     print("      -h, --help:")
     print("        show this help file")
     print("      -f, --flavour:")
-    print("        set flavourname to use (default is the current logged in user)")
+    print("        set flavourname to use (default is the current logged in user), for build")
+    print("        several can be given separated by commas")
     print("      -l, --local:")
     print("        set (dch) local name to use (else this is asked interactively)")
+    print("      -w, --worktree:")
+    print("        generate the config in a separate git worktree (kept in .git/ukh-worktrees and reused)")
+    print("        so the current tree does not need to be reset, note that this uses the committed")
+    print("        state of the tree apart from the source config")
+    print("      -b, --batch <file>:")
+    print("        generate several flavours without asking, one per line in <file> as")
+    print("          <flavour> <arch> [generic|running|<path to config>]")
+    print("        each in a worktree of its own and several at the same time (see --jobs), the")
+    print("        results are only added to the current tree if all of them succeeded")
+    print("      -j, --jobs <n>:")
+    print("        number of flavours to generate at the same time in batch mode, for build the number")
+    print("        of compile jobs shared out among the flavours (default: number of cpus)")
+    print("      -c, --ccache:")
+    print("        build using ccache (/usr/lib/ccache is put in front of PATH)")
+    print("      -a, --arch <config>:")
+    print("        use this config (e.g. amd64) instead of asking for it")
+    print("      -o, --overlay <file>:")
+    print("        kernel config fragment (CONFIG_X=y, # CONFIG_Y is not set) with our own changes,")
+    print("        they are applied to the new flavour config before running updateconfigs")
+    print("      -d, --diff:")
+    print("        only show the differences between the running, generic and flavour config")
+    print("      --list:")
+    print("        only show what the debian tree contains (configs, flavours, abi versions etc.)")
+    print("      --refresh:")
+    print("        scan the debian tree again instead of using the index kept in .git/ukh-cache")
+    print("      -n, --dry-run:")
+    print("        only show which files would be changed to register the flavours (needs --worktree")
+    print("        or --batch so the current tree is not touched while generating the config)")
+    print("      -t, --timeout <seconds>:")
+    print("        kill commands that take longer than this (e.g. a hanging updateconfigs)")
+    print("      --log <file>:")
+    print("        append the complete output of all commands run to <file>")
+    print("      --no-daemon:")
+    print("        do not use a daemon serving the tree")
+    print("      --trace <file>:")
+    print("        record how long every command and file operation took, write it to <file> as Chrome")
+    print("        trace events (for chrome://tracing or ui.perfetto.dev) and print a summary at the end")
     
 
-def main():
+def main(argv = None):
+    global LOGFILE, TIMEOUT, TRACEFILE
+    if argv is None:
+        argv = sys.argv[1:]
     flavourname = pwd.getpwuid(os.getuid())[0].lower().strip()
     localname   = None
+    useworktree = False
+    batchfile   = None
+    jobs        = multiprocessing.cpu_count()
+    archparam   = None
+    overlay     = None
+    showdiff    = False
+    listonly    = False
+    refresh     = False
+    dryrun      = False
+    useccache   = False
+    nodaemon    = False
     try:
-        opts, args = gnu_getopt(sys.argv[1:], 'hf:l:', ['help', 'flavour=', 'local='])
+        opts, args = gnu_getopt(argv, 'hf:l:t:wb:j:a:o:dnc', ['help', 'flavour=', 'local=', 'log=', 'timeout=', 'worktree',
+                                                                       'batch=', 'jobs=', 'arch=', 'overlay=', 'diff',
+                                                                       'list', 'refresh', 'dry-run', 'ccache', 'trace=',
+                                                                       'no-daemon'])
         for opt, param in opts:
             if opt == '-h' or opt == '--help':
                 usage()
@@ -290,6 +1378,48 @@ def main():
                 flavourname = param
             elif opt == '-l' or opt == '--local':
                 localname = param
+            elif opt == '-w' or opt == '--worktree':
+                useworktree = True
+            elif opt == '-a' or opt == '--arch':
+                archparam = param
+            elif opt == '-o' or opt == '--overlay':
+                try:
+                    with open(param, "rt") as fh:
+                        overlay = parse_config(fh.read())
+                except IOError, e:
+                    print("Error reading overlay '%s' : '%s'" % (param, str(e)))
+                    return
+            elif opt == '-d' or opt == '--diff':
+                showdiff = True
+            elif opt == '--list':
+                listonly = True
+            elif opt == '--refresh':
+                refresh = True
+            elif opt == '-n' or opt == '--dry-run':
+                dryrun = True
+            elif opt == '-c' or opt == '--ccache':
+                useccache = True
+            elif opt == '-b' or opt == '--batch':
+                batchfile = param
+            elif opt == '-j' or opt == '--jobs':
+                try:
+                    jobs = max(1, int(param))
+                except ValueError:
+                    print("Error: invalid number of jobs '%s'" % param)
+                    return
+            elif opt == '-t' or opt == '--timeout':
+                try:
+                    TIMEOUT = int(param)
+                except ValueError:
+                    print("Error: invalid timeout '%s'" % param)
+                    return
+            elif opt == '--log':
+                LOGFILE = os.path.abspath(param)
+            elif opt == '--no-daemon':
+                nodaemon = True
+            elif opt == '--trace':
+                TRACEFILE = os.path.abspath(param)
+                tracer.enable()
             else:
                 print("Error: unexpected option in command line: '%s" % opt)
                 return
@@ -298,8 +1428,45 @@ def main():
         print ("Error parsing command line arguments: '%s'" % str(e))
         return
 
-   
-    buf, err = pexec(["lsb_release" , "-c"])
+    if args not in ( [], [ "build" ], [ "daemon" ] ):
+        print("Error: unknown command '%s'" % ' '.join(args))
+        return
+
+    if "debian" not in os.listdir('.'):
+        print("Error: script must be run in top ubuntu linux tree git directory")
+        return
+
+    if args == [ "daemon" ]:
+        run_daemon()
+        return
+    if args == [] and not nodaemon and forward_to_daemon(argv):
+        TRACEFILE = None # written by the daemon
+        return
+
+    index = treeindex.get(refresh)
+    if not index:
+        return
+    if listonly:
+        print_index(index)
+        return
+    debiandir = index["debiandir"]
+
+    if args == [ "build" ]:
+        flavours = flavourname.split(',')
+        if batchfile:
+            entries = read_batch(batchfile)
+            if not entries:
+                return
+            flavours = sorted(set(e[0] for e in entries))
+        known = set(f for arch in index["arches"].values() for f in arch)
+        unknown = [ f for f in flavours if f not in known ]
+        if unknown:
+            print("Error: unknown flavours %s, available are: %s" % (', '.join(unknown), ', '.join(sorted(known))))
+            return
+        build_flavours(flavours, jobs, useccache)
+        return
+
+    buf, err = cached_pexec(["lsb_release" , "-c"])
     if not err:
         m = re.match(".*Codename:\s+(.*)", buf)
         if m:
@@ -314,59 +1481,75 @@ def main():
     if codename not in [ "precise", "trusty" ]:
         print("Warning, untested combination")
 
-
-    if "debian" not in os.listdir('.'):
-        print("Error: script must be run in top ubuntu linux tree git directory")
+    if dryrun and not (useworktree or batchfile):
+        print("Error: --dry-run needs --worktree or --batch")
         return
 
-    debiandir = None
 
-    # this depends on what is set up in debian.env
-    try:
-        with open(os.path.join(os.getcwd(),"debian","debian.env"),'rt') as envfh:
-            envvar = envfh.readlines()
-            for l in envvar:
-                m = re.match("DEBIAN\s*=\s*(.+)", l)
-                if m:
-                    debiandir, = m.groups()
-                    break
-    except Exception,exc:
-        print("Error opening debian environment setup:\n'%s'" % str(exc))
-        return
-    
-    if debiandir == None:
-        print("Error getting debian branch directory from debian/debian.env")
-        return
-    
-    arch = get_arch(debiandir)
+    flavours = [ flavourname ]
+    if batchfile:
+        entries = read_batch(batchfile)
+        if not entries:
+            return
+        if not dryrun:
+            localname = ask_local(localname)
+        if not generate_batch(entries, debiandir, jobs, overlay, dryrun, localname):
+            return
+        if dryrun:
+            return
+        flavours = sorted(set(e[0] for e in entries))
+        arch = None
+    else:
+        arch = get_arch(index, archparam)
+        if arch and showdiff:
+            show_config_diff(flavourname, arch, debiandir)
+            return
     if arch:
-        config = generate_flavour(flavourname, arch, debiandir)
-        if config:
-            patch_flavour(flavourname, config, arch, debiandir, localname)
-        else:
+        worktree = None
+        if useworktree:
+            pool = WorktreePool()
+            worktree = pool.acquire()
+            if not worktree:
+                return
+        try:
+            config = generate_flavour(flavourname, arch, debiandir, worktree, overlay = overlay)
+        finally:
+            if worktree:
+                pool.release(worktree)
+        if not config or not patch_flavour(flavourname, config, arch, debiandir, localname, worktree is None, dryrun):
+            return
+        if dryrun:
             return
 
     print("all patching done")
     print("you can now e.g. commit the changes:")
     print("")
     print("  git add .")
-    print("  git commit -a -m \"%s modifications\"" % flavourname)
+    print("  git commit -a -m \"%s modifications\"" % ', '.join(flavours))
     print("")
     print("then build them:")
     print("")
+    print("  %s build -f %s" % (os.path.basename(sys.argv[0]), ','.join(flavours)))
+    print("")
+    print("which runs these (binary-perarch after the others):")
+    print("")
     print("  skipabi=true skipmodule=true fakeroot debian/rules binary-indep")
     print("  skipabi=true skipmodule=true fakeroot debian/rules binary-perarch")
-    print("  skipabi=true skipmodule=true fakeroot debian/rules binary-%s" % flavourname)
+    for flavourname in flavours:
+        print("  skipabi=true skipmodule=true fakeroot debian/rules binary-%s" % flavourname)
     print("")
     print("if you want to create a debug package you can do it this way:")
     print("")
     # note that skipdbg is not part of the environment because the Makefiles assume that you do not
     # want a fully blown debug package when not doing a "full_build". Setting full_build is not an
     # option since this adds targets that we do not want to build. So use a variable override here.
-    print("  skipabi=true skipmodule=true fakeroot debian/rules binary-%s skipdbg=false" % flavourname)
+    print("  skipabi=true skipmodule=true fakeroot debian/rules binary-%s skipdbg=false" % flavours[0])
 
 
-try:
-    main()
-except KeyboardInterrupt:
-    pass
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
+    kernelconfigs.save()
+    finish_trace()